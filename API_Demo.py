@@ -10,28 +10,95 @@ An API program allowing users to import TV shows from the TV maze API
 
 import json
 import sqlite3
-from pandas.io import sql
 import datetime as dt
 
-import pandas as pd
 from flask import Flask
+from flask import current_app
+from flask import g
+from flask import has_app_context
 from flask import request
-from flask import send_from_directory
+from flask import send_file
+from werkzeug.http import http_date
 from flask_restx import Resource, Api
 from flask_restx import fields
 from flask_restx import reqparse
 import os
 import math
+import base64
+import threading
+from collections import OrderedDict
+import atexit
+import hashlib
+import io
+import csv
+import re
+import html
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from contextlib import contextmanager
+import time
+import cProfile
+import pstats
 
-import matplotlib.pyplot as plt
+import tvmaze
+import metrics
 
-app = Flask(__name__)
-api = Api(app,
-          version="1.0",
+# orjson is much quicker at encoding responses, but it's optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The app itself is made by create_app; routes are registered on the Api now
+# and added to the app when it's made
+api = Api(version="1.0",
           default='TV Shows',
           title='TV Shows Dataset',
           description="An API for TV shows; imports from the TVMaze API and stores locally")
 
+# Timings for /metrics: whole requests, the time each request spends in each
+# phase (DB, JSON encoding, TVMaze, charts), and every SQL statement
+registry = metrics.Registry()
+request_seconds = registry.histogram('api_demo_request_seconds', 'Time to handle a request',
+                                     ['endpoint', 'method', 'status'])
+phase_seconds = registry.histogram('api_demo_request_phase_seconds', 'Time a request spent in each phase',
+                                   ['endpoint', 'phase'])
+sql_seconds = registry.histogram('api_demo_sql_seconds', 'Time to execute an SQL statement',
+                                 ['statement'], buckets=metrics.sql_buckets)
+tvmaze_seconds = registry.histogram('api_demo_tvmaze_seconds', 'Time to look a show up on TVMaze', ['call'])
+
+
+def add_phase(name, seconds):
+    # Count time towards a phase of the current request; work done outside
+    # a request (or on another thread) isn't part of one
+    if has_app_context() and 'phases' in g:
+        g.phases[name] = g.phases.get(name, 0) + seconds
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - start)
+
+
+def dumps(obj):
+    # Encode a payload to JSON bytes, once, with the fastest encoder we have
+    with phase('serialize'):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    # Replaces flask-restx's own encoder, so every payload is encoded by dumps
+    resp = current_app.response_class(dumps(data), status=code, mimetype='application/json')
+    resp.headers.extend(headers or {})
+    return resp
+
 import_model = api.model('Import', {
     'name': fields.String})
 
@@ -52,10 +119,880 @@ show_model = api.model('Show', {
     'summary': fields.String,
     '_links': fields.String})
 
+table_name = 'TV_Shows'
+
+# Everything about how we talk to SQLite lives here. Each thread gets its own
+# connection which is reused between requests; WAL journaling lets readers
+# carry on while a write is in progress.
+db_config = {'database': 'storage.db',
+             'timeout': 30,               # seconds to wait on a locked DB
+             'journal_mode': 'WAL',
+             'synchronous': 'NORMAL',     # safe with WAL, fewer fsyncs
+             'cache_size': -64000,        # negative means KiB, so 64MB
+             'mmap_size': 268435456}      # 256MB
+
+# Columns stored for each show, in DB order. Types are declared explicitly so
+# that sorting (e.g. by runtime or premiered) can happen inside SQLite rather
+# than after casting a DataFrame in Python. The nested schedule, rating and
+# network objects are split into plain columns, and genres live in their own
+# table, so nothing needs decoding per row when reading.
+show_columns = {'tvmaze-id': 'INTEGER PRIMARY KEY',
+                'name': 'TEXT',
+                'type': 'TEXT',
+                'language': 'TEXT',
+                'status': 'TEXT',
+                'runtime': 'INTEGER',
+                'premiered': 'TEXT',
+                'officialSite': 'TEXT',
+                'schedule-time': 'TEXT',
+                'schedule-days': 'TEXT',      # comma separated
+                'rating-average': 'REAL',
+                'weight': 'INTEGER',
+                'network-id': 'INTEGER',
+                'network-name': 'TEXT',
+                'network-country': 'TEXT',
+                'network-country-code': 'TEXT',
+                'network-timezone': 'TEXT',
+                'summary': 'TEXT',
+                'summary-text': 'TEXT',       # the summary without HTML, for searching
+                'last-update': 'TEXT',
+                'tvmaze-updated': 'INTEGER'}  # TVMaze's own update time, for refreshes
+
+# Fields returned (in this order) when fetching a single show
+detail_fields = ['tvmaze-id','name','last-update','type','language','genres',
+                 'status','runtime','premiered','officialSite','schedule',
+                 'rating','weight','network','summary']
+
+# API fields which aren't a column of their own, and the columns they're
+# rebuilt from (genres come from the Show_Genres table instead)
+nested_fields = {'genres': [],
+                 'schedule': ['schedule-time','schedule-days'],
+                 'rating': ['rating-average'],
+                 'network': ['network-id','network-name','network-country',
+                             'network-country-code','network-timezone']}
+
+# Bumped whenever the table layout changes; stored in the DB's user_version
+# so that init_db knows which migrations an existing file still needs
+schema_version = 9
+
+# Where shows are imported from; 'url' can point at a local stub for testing,
+# or 'fixtures' at a directory of recorded responses to work offline (with
+# 'record' set, responses missing from it are fetched from 'url' and saved)
+tvmaze_config = {'url': 'http://api.tvmaze.com',
+                 'timeout': 10,        # seconds per request
+                 'workers': 8,         # concurrent requests for bulk imports
+                 'retries': 3,
+                 'backoff': 0.5,       # seconds, doubled on each retry
+                 'cache_size': 1024,   # responses kept in memory
+                 'cache_ttl': 3600,    # seconds
+                 'fixtures': None,
+                 'record': False}
+
+# Fields counted for the statistics endpoint, and the genres treated as
+# themes (everything else is a sub-genre) when breaking down genres
+stats_fields = ['language','status','type']
+theme_genres = ['Adventure','Action','Drama','Comedy','Thriller','Horror']
+
+# Fields the list endpoint can be ordered by, and the column each maps to
+sortable = {'id': 'tvmaze-id',
+            'name': 'name',
+            'runtime': 'runtime',
+            'premiered': 'premiered',
+            'rating-average': 'rating-average'}
+
+# Predicates a listing can be narrowed down by. The match ones take a comma
+# separated list of values (any of which will do) for a column; the range
+# ones compare a column against a single bound.
+match_predicates = {'language': 'language',
+                    'status': 'status',
+                    'type': 'type',
+                    'network': 'network-name'}
+range_predicates = {'premiered_from': ('premiered', '>='),
+                    'premiered_to': ('premiered', '<='),
+                    'min_rating': ('rating-average', '>=')}
+predicate_names = list(match_predicates) + ['genre'] + list(range_predicates)
+
+# Indexes for the predicates, each finishing on the id so that a filtered
+# listing in id order reads just the matching rows, already sorted
+predicate_indexes = {'language_status': ['language', 'status'],
+                     'status': ['status'],
+                     'type': ['type'],
+                     'network': ['network-name']}
+
+
+def quote(col):
+    # Most of our column names contain hyphens, so always quote identifiers
+    return '"' + col.replace('"', '""') + '"'
+
+
+def get_config(name):
+    # The current app's 'db', 'tvmaze', 'cache' or 'snapshot' settings (see
+    # create_app). Outside an app, e.g. in refresh.py, the module's own
+    # settings above are used instead.
+    if has_app_context() and 'api_demo' in current_app.extensions:
+        return current_app.extensions['api_demo'][name]
+    return {'db': db_config, 'tvmaze': tvmaze_config, 'cache': cache_config, 'snapshot': snapshot_config}[name]
+
+
+_local = threading.local()
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class TimedConnection(sqlite3.Connection):
+    # Records how long each statement takes to execute (for a SELECT, up to
+    # its first row; rows fetched after that aren't counted)
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, seconds):
+        statement = sql.split(None, 1)[0].upper() if sql.strip() else ''
+        sql_seconds.observe(seconds, statement)
+        add_phase('db', seconds)
+
+
+def connect(database=None, config=None):
+    # Open a new connection with our pragmas applied, from the db settings
+    # given or else those of the current app
+    config = config or get_config('db')
+    database = database or config['database']
+    cnx = sqlite3.connect(database, timeout=config['timeout'], check_same_thread=False,
+                          factory=TimedConnection)
+    cnx.execute(f'PRAGMA busy_timeout = {int(config["timeout"] * 1000)}')
+    cnx.execute(f'PRAGMA journal_mode = {config["journal_mode"]}')
+    cnx.execute(f'PRAGMA synchronous = {config["synchronous"]}')
+    cnx.execute(f'PRAGMA cache_size = {int(config["cache_size"])}')
+    cnx.execute(f'PRAGMA mmap_size = {int(config["mmap_size"])}')
+    return cnx
+
+
+def strip_html(text):
+    # Summaries come from TVMaze as HTML; index just the words. Done in
+    # Python as shows are written (into summary-text), so the triggers on
+    # the table are plain SQL and any program can write to it.
+    if text is None:
+        return None
+    return html.unescape(re.sub(r'<[^>]*>', ' ', text))
+
+
+def get_db():
+    # Return this thread's connection, opening it on first use (or if it's
+    # for a different app's database)
+    database = get_config('db')['database']
+    cnx = getattr(_local, 'cnx', None)
+    if cnx is not None and _local.database == database:
+        return cnx
+
+    if cnx is not None:
+        close_db()
+
+    cnx = connect(database)
+    _local.cnx = cnx
+    _local.database = database
+
+    with _connections_lock:
+        # Threads come and go (e.g. one per request on the dev server), so
+        # close anything left behind by threads which have since finished
+        alive = set(thread.ident for thread in threading.enumerate())
+        for ident in [ident for ident in _connections if ident not in alive]:
+            _connections.pop(ident).close()
+        _connections[threading.get_ident()] = cnx
+
+    return cnx
+
+
+def close_db():
+    # Close this thread's connection, if it has one
+    cnx = getattr(_local, 'cnx', None)
+    if cnx is None:
+        return
+    _local.cnx = None
+    with _connections_lock:
+        _connections.pop(threading.get_ident(), None)
+    cnx.close()
+
+
+@atexit.register
+def close_all():
+    # Close every connection we've handed out
+    with _connections_lock:
+        for cnx in _connections.values():
+            cnx.close()
+        _connections.clear()
+    _local.cnx = None
+
+
+def start_request():
+    g.started = time.perf_counter()
+    g.phases = {}
+
+    # In debug mode, ?profile=1 swaps the response for a cProfile summary of
+    # handling the request
+    if current_app.debug and request.args.get('profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_seconds.observe(time.perf_counter() - g.started, endpoint, request.method, str(response.status_code))
+    for name, seconds in g.phases.items():
+        phase_seconds.observe(seconds, endpoint, name)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        return current_app.response_class(out.getvalue(), mimetype='text/plain')
+
+    return response
+
+
+def end_request(exc):
+    # Connections outlive requests, so never leave a transaction open on one
+    cnx = getattr(_local, 'cnx', None)
+    if cnx is not None and cnx.in_transaction:
+        cnx.rollback()
+
+
+def init_db(cnx):
+    # Create the shows tables if missing, or bring an older DB up to date.
+    # It's all one transaction, taken before looking at the DB, so server
+    # processes starting together don't each try to migrate it, and a
+    # migration that fails part way leaves the DB as it was.
+    with cnx:
+        cnx.execute('BEGIN IMMEDIATE')
+        exists = cnx.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                             (table_name,)).fetchone()
+        version = cnx.execute('PRAGMA user_version').fetchone()[0]
+
+        if not exists:
+            create_table(cnx)
+        cnx.execute('CREATE TABLE IF NOT EXISTS Show_Genres '
+                    '(show_id INTEGER, position INTEGER, genre TEXT, PRIMARY KEY (show_id, position))')
+        if exists and version < 4:
+            migrate_table(cnx)
+        elif exists:
+            if version < 5:
+                cnx.execute(f'ALTER TABLE {table_name} ADD COLUMN "tvmaze-updated" INTEGER')
+            if version < 7:
+                cnx.execute(f'ALTER TABLE {table_name} ADD COLUMN "row-version" INTEGER NOT NULL DEFAULT 1')
+            if version < 9:
+                cnx.execute(f'ALTER TABLE {table_name} ADD COLUMN "summary-text" TEXT')
+        if exists and version < 9:
+            fill_summary_text(cnx)
+
+        for field, col in sortable.items():
+            if col != 'tvmaze-id':
+                cnx.execute(f'CREATE INDEX IF NOT EXISTS {quote("idx_" + field)} '
+                            f'ON {table_name} ({quote(col)}, "tvmaze-id")')
+        for name, cols in predicate_indexes.items():
+            cnx.execute(f'CREATE INDEX IF NOT EXISTS {quote("idx_" + name)} '
+                        f'ON {table_name} ({", ".join(quote(col) for col in cols)}, "tvmaze-id")')
+        cnx.execute(f'CREATE INDEX IF NOT EXISTS idx_last_update ON {table_name} ("last-update")')
+        cnx.execute('CREATE INDEX IF NOT EXISTS idx_genre ON Show_Genres (genre, show_id)')
+
+        # A show's genres go with it
+        cnx.execute(f'CREATE TRIGGER IF NOT EXISTS genres_delete AFTER DELETE ON {table_name} '
+                    f'BEGIN DELETE FROM Show_Genres WHERE show_id = OLD."tvmaze-id"; END')
+
+        create_stats(cnx)
+        if exists and version < 4:
+            rebuild_stats(cnx)
+        create_version(cnx)
+        create_changes(cnx)
+
+        # Search triggers from before version 9 called a Python function that
+        # other programs don't have; replace them with the plain SQL ones
+        if exists and version < 9:
+            for name in ['search_insert', 'search_update']:
+                cnx.execute(f'DROP TRIGGER IF EXISTS {name}')
+        create_search(cnx)
+        if exists and version < 9:
+            rebuild_search(cnx)
+
+        cnx.execute(f'PRAGMA user_version = {schema_version}')
+
+
+def create_table(cnx):
+    # Besides the columns of the show itself, every row has a version that
+    # each change to it bumps, for conditional (If-Match) updates and deletes
+    cols = ', '.join(f'{quote(col)} {kind}' for col, kind in show_columns.items())
+    cnx.execute(f'CREATE TABLE {table_name} ({cols}, "row-version" INTEGER NOT NULL DEFAULT 1)')
+
+
+def migrate_table(cnx):
+    # DBs made by earlier versions kept genres, schedule, rating and network
+    # as JSON strings (and the very first ones were created by pandas from an
+    # empty DataFrame: an 'index' column, every column TEXT and no key on the
+    # id). Copy the rows into the current typed table keyed on tvmaze-id,
+    # splitting the JSON out into columns and the Show_Genres table.
+    cnx.execute(f'ALTER TABLE {table_name} RENAME TO {table_name}_old')
+    for row in cnx.execute("SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = ?",
+                           (f'{table_name}_old',)).fetchall():
+        cnx.execute(f'DROP {row[0].upper()} {quote(row[1])}')
+
+    create_table(cnx)
+
+    def valid(col, expr):
+        return f'CASE WHEN json_valid({col}) THEN {expr} END'
+
+    country = "CASE json_type(network, '$.country') WHEN 'object' THEN json_extract(network, '$.country.name') " \
+              "ELSE json_extract(network, '$.country') END"
+    days = "CASE json_type(schedule, '$.days') WHEN 'array' THEN " \
+           "COALESCE((SELECT group_concat(value, ',') FROM json_each(schedule, '$.days')), '') END"
+
+    convert = {'tvmaze-id': 'CAST("tvmaze-id" AS INTEGER)',
+               'runtime': 'CAST(CAST(runtime AS REAL) AS INTEGER)',
+               'weight': 'CAST(CAST(weight AS REAL) AS INTEGER)',
+               'schedule-time': valid('schedule', "json_extract(schedule, '$.time')"),
+               'schedule-days': valid('schedule', days),
+               'rating-average': valid('rating', "json_extract(rating, '$.average')"),
+               'network-id': valid('network', "json_extract(network, '$.id')"),
+               'network-name': valid('network', "json_extract(network, '$.name')"),
+               'network-country': valid('network', country),
+               'network-country-code': valid('network', "json_extract(network, '$.country.code')"),
+               'network-timezone': valid('network', "json_extract(network, '$.country.timezone')"),
+               'summary-text': 'NULL'}    # filled in afterwards by fill_summary_text
+    select = ', '.join(convert.get(col, quote(col)) for col in show_columns)
+
+    cnx.execute(f'INSERT OR REPLACE INTO {table_name} ({", ".join(quote(col) for col in show_columns)}) '
+                f'SELECT {select} FROM {table_name}_old WHERE "tvmaze-id" IS NOT NULL')
+    cnx.execute(f'INSERT OR REPLACE INTO Show_Genres (show_id, position, genre) '
+                f'SELECT CAST("tvmaze-id" AS INTEGER), genre.key, genre.value '
+                f"FROM {table_name}_old, json_each(CASE WHEN json_valid(genres) THEN genres ELSE '[]' END) AS genre "
+                f'WHERE "tvmaze-id" IS NOT NULL')
+    cnx.execute(f'DROP TABLE {table_name}_old')
+
+
+def stats_changes(row, sign):
+    # SQL statements (for use in a trigger) that add sign to the counts for
+    # the OLD or NEW show
+    upsert = f'ON CONFLICT DO UPDATE SET count = count + ({sign})'
+
+    statements = [f"INSERT INTO Show_Stats (field, value, count) VALUES ('total', '', {sign}) {upsert}"]
+    for field in stats_fields:
+        statements.append(f"INSERT INTO Show_Stats (field, value, count) SELECT '{field}', {row}.{quote(field)}, {sign} "
+                          f'WHERE {row}.{quote(field)} IS NOT NULL {upsert}')
+    return statements
+
+
+def genre_changes(row, sign):
+    # SQL statements (for use in a trigger on Show_Genres) that add sign to
+    # the counts of each theme/sub-genre pair made with the OLD or NEW genre.
+    # Genres are added and removed one at a time, so each pair is counted
+    # once, when the second of the two arrives (or the first leaves).
+    themes = ', '.join(f"'{genre}'" for genre in theme_genres)
+    upsert = f'ON CONFLICT DO UPDATE SET count = count + ({sign})'
+
+    return [f'INSERT INTO Genre_Stats (theme, genre, count) SELECT {row}.genre, other.genre, {sign} '
+            f'FROM Show_Genres AS other WHERE other.show_id = {row}.show_id '
+            f'AND {row}.genre IN ({themes}) AND other.genre NOT IN ({themes}) {upsert}',
+            f'INSERT INTO Genre_Stats (theme, genre, count) SELECT other.genre, {row}.genre, {sign} '
+            f'FROM Show_Genres AS other WHERE other.show_id = {row}.show_id '
+            f'AND other.genre IN ({themes}) AND {row}.genre NOT IN ({themes}) {upsert}']
+
+
+def create_stats(cnx):
+    # Counts behind the statistics endpoint: per-value counts of language,
+    # status and type (plus the overall total), and counts of each theme and
+    # sub-genre pairing. Triggers keep them in step with every insert, update
+    # and delete on the shows and genres tables.
+    cnx.execute('CREATE TABLE IF NOT EXISTS Show_Stats '
+                '(field TEXT, value TEXT, count INTEGER, PRIMARY KEY (field, value))')
+    cnx.execute('CREATE TABLE IF NOT EXISTS Genre_Stats '
+                '(theme TEXT, genre TEXT, count INTEGER, PRIMARY KEY (theme, genre))')
+
+    cleanup = ['DELETE FROM Show_Stats WHERE count <= 0',
+               'DELETE FROM Genre_Stats WHERE count <= 0']
+    watched = ', '.join(quote(col) for col in stats_fields)
+
+    triggers = {'stats_insert': (f'AFTER INSERT ON {table_name}', stats_changes('NEW', 1)),
+                'stats_delete': (f'AFTER DELETE ON {table_name}', stats_changes('OLD', -1) + cleanup),
+                'stats_update': (f'AFTER UPDATE OF {watched} ON {table_name}',
+                                 stats_changes('OLD', -1) + stats_changes('NEW', 1) + cleanup),
+                'genre_stats_insert': ('AFTER INSERT ON Show_Genres', genre_changes('NEW', 1)),
+                'genre_stats_delete': ('AFTER DELETE ON Show_Genres', genre_changes('OLD', -1) + cleanup)}
+
+    for name, (event, statements) in triggers.items():
+        body = ''.join(f'{statement}; ' for statement in statements)
+        cnx.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body}END')
+
+
+def create_version(cnx):
+    # A single counter bumped by every write to the shows table, so that
+    # anything derived from the table (e.g. rendered charts) can tell when
+    # it's out of date. Kept in the DB so all workers see the same value.
+    cnx.execute('CREATE TABLE IF NOT EXISTS Show_Version '
+                '(id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER, updated TEXT)')
+    cnx.execute("INSERT OR IGNORE INTO Show_Version (id, version, updated) "
+                "VALUES (0, 0, strftime('%Y-%m-%d %H:%M:%S', 'now'))")
+
+    bump = "UPDATE Show_Version SET version = version + 1, updated = strftime('%Y-%m-%d %H:%M:%S', 'now');"
+    for event in ['INSERT','UPDATE','DELETE']:
+        cnx.execute(f'CREATE TRIGGER IF NOT EXISTS version_{event.lower()} AFTER {event} ON {table_name} '
+                    f'BEGIN {bump} END')
+
+
+def create_changes(cnx):
+    # The data version at which each show last changed, for copies of the
+    # shows kept elsewhere (the statistics snapshot) to catch up on just the
+    # shows changed since they were made. One row per show id ever stored.
+    cnx.execute('CREATE TABLE IF NOT EXISTS Show_Changes (show_id INTEGER PRIMARY KEY, version INTEGER)')
+    cnx.execute('CREATE INDEX IF NOT EXISTS idx_changes_version ON Show_Changes (version)')
 
+    log = 'INSERT OR REPLACE INTO Show_Changes (show_id, version) VALUES ({}."tvmaze-id", (SELECT version FROM Show_Version));'
+    for event, row in [('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')]:
+        cnx.execute(f'CREATE TRIGGER IF NOT EXISTS changes_{event.lower()} AFTER {event} ON {table_name} '
+                    f'BEGIN {log.format(row)} END')
+
+
+def create_search(cnx):
+    # Full text index over show names and (HTML-stripped) summaries, keyed
+    # by the show id, and the triggers that keep it in step with the shows.
+    # We always write summary-text along with the summary; a program that
+    # only sets the summary gets it indexed as it is, tags and all.
+    cnx.execute("CREATE VIRTUAL TABLE IF NOT EXISTS Show_Search USING fts5(name, summary, "
+                "tokenize = 'unicode61 remove_diacritics 2')")
+
+    text = ('CASE WHEN NEW."summary-text" IS OLD."summary-text" AND NEW.summary IS NOT OLD.summary '
+            'THEN NEW.summary ELSE COALESCE(NEW."summary-text", NEW.summary) END')
+    triggers = {'search_insert': (f'AFTER INSERT ON {table_name}',
+                                  'INSERT INTO Show_Search (rowid, name, summary) '
+                                  'VALUES (NEW."tvmaze-id", NEW.name, COALESCE(NEW."summary-text", NEW.summary))'),
+                'search_delete': (f'AFTER DELETE ON {table_name}',
+                                  'DELETE FROM Show_Search WHERE rowid = OLD."tvmaze-id"'),
+                'search_update': (f'AFTER UPDATE OF name, summary, "summary-text" ON {table_name}',
+                                  f'UPDATE Show_Search SET name = NEW.name, summary = {text} '
+                                  'WHERE rowid = NEW."tvmaze-id"')}
+
+    for name, (event, statement) in triggers.items():
+        cnx.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {statement}; END')
+
+
+def rebuild_search(cnx):
+    # Re-index every show from scratch, as part of the caller's transaction
+    cnx.execute('DELETE FROM Show_Search')
+    cnx.execute(f'INSERT INTO Show_Search (rowid, name, summary) '
+                f'SELECT "tvmaze-id", name, COALESCE("summary-text", summary) FROM {table_name}')
+
+
+def fill_summary_text(cnx, batch_size=1000):
+    # Strip the HTML from every stored summary into summary-text
+    last = -1
+    while True:
+        rows = cnx.execute(f'SELECT "tvmaze-id", summary FROM {table_name} WHERE "tvmaze-id" > ? '
+                           f'ORDER BY "tvmaze-id" LIMIT ?', (last, batch_size)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        cnx.executemany(f'UPDATE {table_name} SET "summary-text" = ? WHERE "tvmaze-id" = ?',
+                        [(strip_html(summary), id) for id, summary in rows])
+
+
+def data_version(cnx):
+    # Current (version, last modified in UTC) of the shows table
+    version, updated = cnx.execute('SELECT version, updated FROM Show_Version').fetchone()
+    return version, dt.datetime.strptime(updated, '%Y-%m-%d %H:%M:%S').replace(tzinfo=dt.timezone.utc)
+
+
+def rebuild_stats(cnx):
+    # Recount everything from scratch, e.g. after the triggers were added, as
+    # part of the caller's transaction
+    themes = ', '.join(f"'{genre}'" for genre in theme_genres)
+
+    cnx.execute('DELETE FROM Show_Stats')
+    cnx.execute('DELETE FROM Genre_Stats')
+    cnx.execute(f"INSERT INTO Show_Stats (field, value, count) SELECT 'total', '', COUNT(*) FROM {table_name}")
+    for field in stats_fields:
+        cnx.execute(f"INSERT INTO Show_Stats (field, value, count) SELECT '{field}', {quote(field)}, COUNT(*) "
+                    f'FROM {table_name} WHERE {quote(field)} IS NOT NULL GROUP BY {quote(field)}')
+    cnx.execute(f'INSERT INTO Genre_Stats (theme, genre, count) SELECT theme.genre, sub.genre, COUNT(*) '
+                f'FROM Show_Genres AS theme JOIN Show_Genres AS sub ON sub.show_id = theme.show_id '
+                f'WHERE theme.genre IN ({themes}) AND sub.genre NOT IN ({themes}) '
+                f'GROUP BY theme.genre, sub.genre')
+
+
+def flatten(field, value):
+    # Column values for one of the nested API fields (other than genres)
+    if field == 'schedule':
+        value = value or {}
+        days = value.get('days')
+        return {'schedule-time': value.get('time'),
+                'schedule-days': None if days is None else ','.join(days)}
+    if field == 'rating':
+        return {'rating-average': (value or {}).get('average')}
+    if field == 'network':
+        value = value or {}
+        country = value.get('country')
+        if not isinstance(country, dict):
+            country = {'name': country}
+        return {'network-id': value.get('id'),
+                'network-name': value.get('name'),
+                'network-country': country.get('name'),
+                'network-country-code': country.get('code'),
+                'network-timezone': country.get('timezone')}
+
+
+def show_values(show):
+    # Split a show as TVMaze returns it into our columns and its genres
+    values = {col: show.get(col) for col in show_columns if col in show}
+    values['tvmaze-id'] = show['id']
+    values['tvmaze-updated'] = show.get('updated')
+    values['summary-text'] = strip_html(show.get('summary'))
+    for field in ['schedule','rating','network']:
+        values.update(flatten(field, show.get(field)))
+    return values, show.get('genres') or []
+
+
+def save_genres(cnx, id, genres):
+    # Replace the genres stored for a show
+    cnx.execute('DELETE FROM Show_Genres WHERE show_id = ?', (id,))
+    cnx.executemany('INSERT INTO Show_Genres (show_id, position, genre) VALUES (?, ?, ?)',
+                    [(id, position, genre) for position, genre in enumerate(genres)])
+
+
+def insert_shows(cnx, shows):
+    # Add new shows, given as (values, genres) pairs as from show_values,
+    # with one executemany for the shows and one for their genres
+    cols = ', '.join(quote(col) for col in show_columns)
+    marks = ', '.join('?' for _ in show_columns)
+    cnx.executemany(f'INSERT INTO {table_name} ({cols}) VALUES ({marks})',
+                    [[values.get(col) for col in show_columns] for values, _ in shows])
+    cnx.executemany('INSERT INTO Show_Genres (show_id, position, genre) VALUES (?, ?, ?)',
+                    [(values['tvmaze-id'], position, genre)
+                     for values, genres in shows for position, genre in enumerate(genres)])
+
+
+def update_shows(cnx, shows):
+    # Overwrite stored shows, given as (values, genres) pairs as from
+    # show_values, with one executemany each for the shows and genres.
+    # Shows that aren't stored (any more) are skipped, so their genres
+    # aren't written either; returns the ones that were updated. Call it
+    # after BEGIN IMMEDIATE, so none can be deleted in between.
+    have = existing_ids(cnx, [values['tvmaze-id'] for values, _ in shows])
+    shows = [(values, genres) for values, genres in shows if values['tvmaze-id'] in have]
+    cols = [col for col in show_columns if col != 'tvmaze-id']
+    assign = ', '.join(f'{quote(col)} = ?' for col in cols)
+    cnx.executemany(f'UPDATE {table_name} SET {assign}, "row-version" = "row-version" + 1 WHERE "tvmaze-id" = ?',
+                    [[values.get(col) for col in cols] + [values['tvmaze-id']] for values, _ in shows])
+    cnx.executemany('DELETE FROM Show_Genres WHERE show_id = ?',
+                    [(values['tvmaze-id'],) for values, _ in shows])
+    cnx.executemany('INSERT INTO Show_Genres (show_id, position, genre) VALUES (?, ?, ?)',
+                    [(values['tvmaze-id'], position, genre)
+                     for values, genres in shows for position, genre in enumerate(genres)])
+    return shows
+
+
+def existing_ids(cnx, ids):
+    # Which of the given show ids are already stored
+    return set(row_versions(cnx, ids))
+
+
+def row_versions(cnx, ids):
+    # The current row version of each of the given shows that's stored
+    found = {}
+    ids = list(ids)
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        marks = ', '.join('?' for _ in chunk)
+        found.update(cnx.execute(f'SELECT "tvmaze-id", "row-version" FROM {table_name} '
+                                 f'WHERE "tvmaze-id" IN ({marks})', chunk))
+    return found
+
+
+def if_match_versions():
+    # The row versions an If-Match header allows, or None if the request
+    # isn't conditional (or takes any version, with *). A show's ETag starts
+    # with its row version, and that's all that's compared: the rest changes
+    # along with the links to neighbouring shows, which aren't a conflict.
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return [int(tag.split('-', 1)[0]) for tag in request.if_match.as_set()
+            if tag.split('-', 1)[0].isdigit()]
+
+
+def version_condition(versions):
+    # SQL (and parameters) restricting an UPDATE or DELETE on a show to the
+    # versions from if_match_versions
+    if versions is None:
+        return '', []
+    if not versions:
+        return ' AND 0', []
+    return f' AND "row-version" IN ({", ".join("?" for _ in versions)})', versions
+
+
+def field_columns(fields):
+    # Columns to select to be able to build the given API fields
+    cols = ['tvmaze-id']
+    for field in fields:
+        for col in nested_fields.get(field, [field]):
+            if col != 'id' and col not in cols:
+                cols.append(col)
+    return cols
+
+
+def load_genres(cnx, ids):
+    # Genres for each of the given show ids, in one query
+    genres = {id: [] for id in ids}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        marks = ', '.join('?' for _ in chunk)
+        for show_id, genre in cnx.execute(f'SELECT show_id, genre FROM Show_Genres WHERE show_id IN ({marks}) '
+                                          f'ORDER BY show_id, position', chunk):
+            genres[show_id].append(genre)
+    return genres
+
+
+def build_show(row, fields, genres):
+    # Put a row (a dict of columns) back into the API's shape for the fields
+    # asked for, rebuilding the nested objects
+    show = {}
+    for field in fields:
+        if field == 'id':
+            show[field] = row['tvmaze-id']
+        elif field == 'genres':
+            show[field] = genres.get(row['tvmaze-id'], [])
+        elif field == 'schedule':
+            days = row['schedule-days']
+            show[field] = {'time': row['schedule-time'],
+                           'days': None if days is None else [day for day in days.split(',') if day]}
+        elif field == 'rating':
+            show[field] = {'average': row['rating-average']}
+        elif field == 'network':
+            if row['network-id'] is None and row['network-name'] is None:
+                show[field] = None
+            else:
+                country = {'name': row['network-country'],
+                           'code': row['network-country-code'],
+                           'timezone': row['network-timezone']}
+                show[field] = {'id': row['network-id'],
+                               'name': row['network-name'],
+                               'country': country if any(country.values()) else None}
+        else:
+            show[field] = row[field]
+    return show
+
+
+def fetch_rows(cursor):
+    # All rows from a cursor as dicts of column name to value
+    cols = [desc[0] for desc in cursor.description]
+    return [dict(zip(cols, row)) for row in cursor]
+
+
+def build_shows(cnx, rows, fields):
+    # Build API shaped shows from rows selected with field_columns(fields)
+    genres = load_genres(cnx, [row['tvmaze-id'] for row in rows]) if 'genres' in fields else {}
+    return [build_show(row, fields, genres) for row in rows]
+
+
+def encode_cursor(order_by, values, direction):
+    # Cursors are opaque to clients: the order_by they belong to, the sort
+    # key values of the boundary row and which way to read from it
+    raw = json.dumps({'o': order_by, 'k': values, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    # The cursor's (order_by, values, direction), or None if it isn't one we
+    # could have made: clients can send anything, so check the shape too
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cursor = json.loads(raw)
+        order_by, values, direction = cursor['o'], cursor['k'], cursor['d']
+    except (ValueError, TypeError, KeyError):
+        return None
+
+    if type(order_by) is not str or type(values) is not list or direction not in ['next','prev']:
+        return None
+    if any(type(value) not in [str, int, float, type(None)] for value in values):
+        return None
+    return order_by, values, direction
+
+
+def keyset_after(keys, values):
+    # Build WHERE clauses matching rows that sort strictly after 'values' for
+    # the ORDER BY described by 'keys' (a list of (column, ascending)). The
+    # clauses are returned as segments to be read one after the other, so
+    # each one can be answered by a seek into a (key, id) index.
+    cols = ', '.join(quote(col) for col, _ in keys)
+    marks = ', '.join('?' for _ in keys)
+    directions = set(asc for _, asc in keys)
+
+    # The usual case: a row value comparison, which SQLite can seek on. SQLite
+    # sorts NULLs first ascending and last descending, so when descending on
+    # a single key the NULLs that are still to come are read afterwards.
+    if None not in values and directions == {True}:
+        return [(f'({cols}) > ({marks})', list(values))]
+    if None not in values and directions == {False} and len(keys) <= 2:
+        segments = [(f'({cols}) < ({marks})', list(values))]
+        if len(keys) == 2:
+            segments.append((f'{quote(keys[0][0])} IS NULL', []))
+        return segments
+
+    # Single key whose boundary value is NULL: finish the NULLs, then (when
+    # ascending) carry on into the non-NULL values
+    if len(keys) == 2 and values[0] is None and len(directions) == 1:
+        key, _ = keys[0]
+        if keys[0][1]:
+            return [(f'{quote(key)} IS NULL AND "tvmaze-id" > ?', [values[1]]),
+                    (f'{quote(key)} IS NOT NULL', [])]
+        return [(f'{quote(key)} IS NULL AND "tvmaze-id" < ?', [values[1]])]
+
+    # Otherwise fall back to spelling out every key's comparison
+    def after(col, val, asc):
+        if asc:
+            return (f'{quote(col)} IS NOT NULL', []) if val is None else (f'{quote(col)} > ?', [val])
+        return ('0', []) if val is None else (f'({quote(col)} < ? OR {quote(col)} IS NULL)', [val])
+
+    clauses = []
+    params = []
+    for i, (col, asc) in enumerate(keys):
+        terms = []
+        for (prev_col, _), prev_val in zip(keys[:i], values[:i]):
+            terms.append(f'{quote(prev_col)} IS ?')
+            params.append(prev_val)
+        term, term_params = after(col, values[i], asc)
+        terms.append(term)
+        params.extend(term_params)
+        clauses.append('(' + ' AND '.join(terms) + ')')
+    return [('(' + ' OR '.join(clauses) + ')', params)]
+
+
+
+# Rendered statistics charts keyed by database and 'by'; each is only good
+# for the data version it was drawn from
+chart_cache = {}
+chart_lock = threading.Lock()
+
+
+# Built JSON responses of the list and detail endpoints, keyed on the
+# database and the normalised request, most recently used last; like the
+# charts, each is only good for the data version it was built from
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+cache_config = {'responses': 1024}   # most responses kept
+
+# Rows read (and sent) at a time by the export endpoint
+export_chunk = 1000
+
+
+def cached_response(key, build, tagged=False):
+    # Return the response for key, calling build() for its body only if the
+    # table has changed since it was last built. Bodies are kept already
+    # encoded, so a hit is sent as is, and get a strong ETag so clients can
+    # revalidate with If-None-Match and get a 304 back. With tagged, build()
+    # returns the body and a tag to start the ETag with.
+    cnx = get_db()
+    version, updated = data_version(cnx)
+    key = (get_config('db')['database'], key)
+    
+    with response_cache_lock:
+        cached = response_cache.get(key)
+        if cached is not None and cached['version'] == version:
+            response_cache.move_to_end(key)
+        else:
+            cached = None
+    
+    if cached is None:
+        tag, payload = None, build()
+        if tagged:
+            payload, tag = payload
+        body = dumps(payload)
+        etag = hashlib.sha1(body).hexdigest()
+        cached = {'version': version,
+                  'body': body,
+                  'etag': etag if tag is None else f'{tag}-{etag}'}
+        with response_cache_lock:
+            response_cache[key] = cached
+            response_cache.move_to_end(key)
+            while len(response_cache) > get_config('cache')['responses']:
+                response_cache.popitem(last=False)
+    
+    headers = {'ETag': f'"{cached["etag"]}"',
+               'Last-Modified': http_date(updated),
+               'Cache-Control': 'no-cache'}
+    
+    if request.if_none_match.contains(cached['etag']):
+        return current_app.response_class(status=304, headers=headers)
+    
+    return current_app.response_class(cached['body'], status=200, headers=headers, mimetype='application/json')
+
+
+# The columnar copy of the shows that grouped statistics are worked out
+# from (see snapshot.py), one per database. With 'enabled', create_app
+# builds it at startup; otherwise it's built by the first request that
+# needs it.
+snapshot_config = {'enabled': False}
+_snapshots = {}
+_snapshot_lock = threading.Lock()
+
+
+def snapshot_group(by, metric, width):
+    # Group the shows in the snapshot, first catching it up with any writes
+    # (made by this process or any other) since it was last used
+    import snapshot
+    
+    cnx = get_db()
+    database = get_config('db')['database']
+    with _snapshot_lock:
+        if database not in _snapshots:
+            _snapshots[database] = snapshot.Snapshot(table_name).load(cnx)
+        else:
+            _snapshots[database].sync(cnx)
+        return _snapshots[database].group(by, metric, width)
+
+
+def render_chart(by, counts, values):
+    # Draw the chart for a statistics request and return it as PNG bytes.
+    # Uses a standalone Figure rather than pyplot, whose global state isn't
+    # safe to share between request threads.
+    # pandas and matplotlib take a good part of a second to import and are
+    # only needed here, so they're loaded on the first chart; Agg is forced
+    # so matplotlib never tries to open a GUI backend in a server process.
+    import matplotlib
+    matplotlib.use('Agg')
+    import pandas as pd
+    from matplotlib.figure import Figure
+    
+    fig = Figure(figsize=(8,8))
+    ax = fig.subplots()
+    
+    # Define parameters of chart based on whether it's genres or not
+    if by == 'genres':
+        pd.Series(counts, dtype=float).unstack().plot(kind='bar', 
+                                                      stacked=True, 
+                                                      ylabel='Count',
+                                                      title='Sub-genre of TV shows by theme',
+                                                      ax=ax)
+    else:
+        pd.Series(values, dtype=float).plot(kind='bar', 
+                                            ylabel='percent', 
+                                            rot=90,
+                                            title=f'TV shows by {by}',
+                                            ax=ax)
+    
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
 
 @api.route('/tv-shows/statistics', doc={'params': {'format': 'How to return the object, default is JSON',
-                                                   'by': 'Values to show, default is language'}})
+                                                   'by': 'Values to show, default is language; with a metric (JSON only) '
+                                                         'also network, country, runtime, rating, weight or premiered',
+                                                   'metric': 'count, share (percent of shows), mean-runtime, mean-rating or mean-weight',
+                                                   'width': 'Size of the groups when grouping by a number (e.g. 30 for half hours of runtime)'}})
 class ShowsStats(Resource):
     def get(self):
         
@@ -63,6 +1000,8 @@ class ShowsStats(Resource):
         stats = reqparse.RequestParser()
         stats.add_argument('format', type=str)
         stats.add_argument('by', type=str)
+        stats.add_argument('metric', type=str)
+        stats.add_argument('width', type=float)
         
         args = stats.parse_args()
         
@@ -71,107 +1010,294 @@ class ShowsStats(Resource):
             args['format'] = 'json'
         if args['by'] is None:
             args['by'] = 'language'
-            
-        if args['by'] not in ['language','genres','status','type']:
-            api.abort(404, f'BY parameter must be either language, genres, status, or type; got {args["by"]}')
+        
+        # Anything past the pre-aggregated counts is grouped from the snapshot
+        if args['metric'] is not None or args['width'] is not None or args['by'] not in ['language','genres','status','type']:
+            return self.grouped(args)
             
         if args['format'] not in ['json','image']:
             api.abort(404, f'FORMAT parameter must be either json or image; got {args["format"]}')
         
-        # Grab data
-        cnx = sqlite3.connect(database_file)
-        df = sql.read_sql('SELECT * FROM TV_Shows', cnx)
-        
-        # We're returning a JSON/image of proportions, so convert totals to %
-        def percentify(df, col):
-            temp = df.groupby(col)[col].count()
-            temp = round((temp / temp.sum()) * 100, 1)
-            if args['format'] == 'json':
-                temp = temp.to_json()
-            return temp
+        # Grab the pre-aggregated counts; these are kept up to date by
+        # triggers on the shows table, so we never scan the shows themselves.
+        # The version is read first so a write landing in between can only
+        # make a cached chart look older than it is, never newer.
+        cnx = get_db()
+        version, updated = data_version(cnx)
         
         # Language/status/type are the same returns, but genres is special
         if args['by'] in ['language','status','type']:
-            to_ret = percentify(df, args['by'])
+            
+            # We're returning a JSON/image of proportions, so convert totals to %
+            counts = dict(cnx.execute('SELECT value, count FROM Show_Stats WHERE field = ? ORDER BY value',
+                                      (args['by'],)))
+            total = sum(counts.values())
+            values = {value: round((count / total) * 100, 1) for value, count in counts.items()}
         elif args['by'] == 'genres':
             
             # Genres are quite broad, and include both the thematic categories a show falls into
             # (e.g., comedy, action, drama), as well as the broader subgenre of overall media
             # (e.g., sci fi, fantasy, medical, crime). So I thought it would be worth visualising
-            # what proportion of the former are made up of the latter.
-            
-            # Get only name/genres, then split list into requisite components
-            x = df[['name','genres']]
-            new = x.copy()
-            new['gen_con'] = new['genres'].apply(json.loads)
-            new = new.explode(column='gen_con')
-            
-            # These are our themes -- split the df based on whether the themes
-            # are present or not, then combine the two resulting dataframes
-            theme_genres = ['Adventure','Action','Drama','Comedy','Thriller','Horror']
-            themes = new.loc[new['gen_con'].isin(theme_genres)]
-            cats = new.loc[~new['gen_con'].isin(theme_genres)]
-            cats = cats.dropna()
-            comb = pd.merge(themes, cats, how='inner', on='name')
+            # what proportion of the former are made up of the latter. The counts of each
+            # theme/sub-genre pairing are kept in Genre_Stats.
+            counts = {(theme, genre): count for theme, genre, count in
+                      cnx.execute('SELECT theme, genre, count FROM Genre_Stats ORDER BY theme, genre')}
             
-            # Get only relevant columns and rename, then groupby theme and sub-genre
-            # and calculate percentage of each theme which is made up of each sub-genre
-            comb = comb[['gen_con_x','gen_con_y']]
-            
-            comb.rename(columns={'gen_con_x': 'Theme',
-                                 'gen_con_y': 'Sub-Genre'},
-                        inplace=True)
-            
-            new_comb = comb.groupby(['Theme','Sub-Genre']).size()
-            
-            final_comb = new_comb.groupby(level=0).transform(lambda x: (x / x.sum()) * 100)
-            
-            if args['format'] == 'json':
-                to_ret = final_comb.to_json()             
+            # Calculate percentage of each theme which is made up of each sub-genre
+            theme_totals = {}
+            for (theme, genre), count in counts.items():
+                theme_totals[theme] = theme_totals.get(theme, 0) + count
+            values = {str((theme, genre)): (count / theme_totals[theme]) * 100
+                      for (theme, genre), count in counts.items()}
         
         if args['format'] == 'json':
             
             ret = {}
             
             # Get those shows which have been updated in the last 24 hours
-            df['day'] = pd.to_datetime(df['last-update'], format="%Y%m%d %H:%M:%S")
-            
-            new = df.loc[df['day'] >= (dt.datetime.now() - dt.timedelta(hours=24))]
+            since = str(dt.datetime.now().replace(microsecond=0) - dt.timedelta(hours=24))
             
             # Populate dict
-            ret['total'] = len(df)
-            ret['total-updated'] = len(new)
-            ret['values'] = json.loads(to_ret)
+            ret['total'] = cnx.execute("SELECT COALESCE(SUM(count), 0) FROM Show_Stats WHERE field = 'total'").fetchone()[0]
+            ret['total-updated'] = cnx.execute(f'SELECT COUNT(*) FROM {table_name} WHERE "last-update" >= ?',
+                                               (since,)).fetchone()[0]
+            ret['values'] = values
             
             return ret
         else:
-            # Define parameters of chart based on whether it's genres or not
-            if args['by'] == 'genres':
-                new_comb.unstack().plot(kind='bar', 
-                                        stacked=True, 
-                                        ylabel='Count',
-                                        title='Sub-genre of TV shows by theme',
-                                        figsize=(8,8))
-            else:
-                to_ret.plot(kind='bar', 
-                            ylabel='percent', 
-                            rot=90,
-                            title=f'TV shows by {args["by"]}',
-                            figsize=(8,8))
+            # Charts are cached per 'by' for as long as the data they were
+            # drawn from is unchanged, so polling doesn't redraw them. The
+            # lock is only held to look up and store, not while drawing, so
+            # one render doesn't hold up hits on every other chart.
+            key = (get_config('db')['database'], args['by'])
+            with chart_lock:
+                cached = chart_cache.get(key)
+            if cached is None or cached['version'] != version:
+                with phase('render'):
+                    png = render_chart(args['by'], counts, values)
+                cached = {'version': version,
+                          'png': png,
+                          'etag': hashlib.sha1(png).hexdigest()}
+                with chart_lock:
+                    # A render of newer data may have finished first
+                    if key not in chart_cache or chart_cache[key]['version'] <= version:
+                        chart_cache[key] = cached
             
-            # Save chart as image and send via API
-            plt.savefig("figure.png", bbox_inches='tight')
-            plt.close()
-            directory = os.getcwd()
-            return send_from_directory(directory=directory, filename='Q6.png')
+            # Send the image from memory, answering conditional requests
+            # with a 304 when the client already has this version
+            return send_file(io.BytesIO(cached['png']),
+                             mimetype='image/png',
+                             etag=cached['etag'],
+                             last_modified=updated,
+                             max_age=0,
+                             conditional=True)
+
+    def grouped(self, args):
+        
+        # numpy is optional, and only needed here
+        try:
+            import snapshot
+        except ImportError:
+            api.abort(501, 'Grouped statistics need numpy installed')
+        
+        if args['metric'] is None:
+            args['metric'] = 'count'
+        
+        if args['by'] not in snapshot.dimensions:
+            api.abort(404, f'BY parameter must be one of {", ".join(snapshot.dimensions)}; got {args["by"]}')
+        if args['metric'] not in snapshot.metrics:
+            api.abort(404, f'METRIC parameter must be one of {", ".join(snapshot.metrics)}; got {args["metric"]}')
+        if args['format'] != 'json':
+            api.abort(404, f'FORMAT parameter must be json with a metric or by {args["by"]}; got {args["format"]}')
+        if args['width'] is not None and (args['by'] not in snapshot.numbers or not math.isfinite(args['width'])
+                                          or args['width'] <= 0):
+            api.abort(404, f'WIDTH parameter must be a positive number, and only goes with by {", ".join(snapshot.numbers)}')
+        
+        def build():
+            width = args['width'] or snapshot.widths.get(args['by'])
+            # A width too narrow for the spread of the values would make a
+            # group for every step in between
+            try:
+                values, shows, missing = snapshot_group(args['by'], args['metric'], width)
+            except snapshot.TooManyGroups as err:
+                api.abort(404, f'WIDTH parameter is too small: {err}')
+            
+            ret = {'by': args['by'],
+                   'metric': args['metric']}
+            if args['by'] in snapshot.numbers:
+                ret['width'] = width
+            ret['total'] = shows + missing
+            ret['missing'] = missing
+            ret['values'] = values
+            return ret
+        
+        return cached_response(('stats', args['by'], args['metric'], args['width']), build)
+
+@api.route('/tv-shows/statistics/rebuild')
+class ShowsStatsRebuild(Resource):
+    
+    @api.response(200, 'Statistics rebuilt')
+    @api.doc(description='Admin: recount the statistics tables from scratch from the stored TV shows')
+    def post(self):
+        cnx = get_db()
+        with cnx:
+            rebuild_stats(cnx)
+
+        # The rebuild doesn't touch the shows, so the data version stays the
+        # same; drop anything drawn from the old counts by hand
+        database = get_config('db')['database']
+        with chart_lock:
+            for key in [key for key in chart_cache if key[0] == database]:
+                del chart_cache[key]
+        with _snapshot_lock:
+            _snapshots.pop(database, None)
+        total = cnx.execute("SELECT COALESCE(SUM(count), 0) FROM Show_Stats WHERE field = 'total'").fetchone()[0]
+        return {'message': 'Statistics rebuilt',
+                'total': total}, 200
+
+def check_filter(filt):
+    # Split a filter argument into the fields to return, checking each one
+    # exists; 'id' is just the tvmaze-id
+    filt = filt.split(',')
+    
+    for filt_name in filt:
+        if filt_name not in ['id','rating-average'] + detail_fields:
+            api.abort(404, f'filter must be in the DB; got {filt_name}')
+    
+    return filt
+
+def check_predicates(args):
+    # Compile the predicate arguments into a WHERE clause; values only ever
+    # go in as parameters. A genre is looked up through Show_Genres, whose
+    # (genre, show_id) index hands back the matching ids directly.
+    clauses = []
+    params = []
+    
+    for name, col in match_predicates.items():
+        if args[name] is not None:
+            values = args[name].split(',')
+            clauses.append(f'{quote(col)} IN ({", ".join("?" * len(values))})')
+            params += values
+    
+    if args['genre'] is not None:
+        values = args['genre'].split(',')
+        clauses.append(f'"tvmaze-id" IN (SELECT show_id FROM Show_Genres WHERE genre IN ({", ".join("?" * len(values))}))')
+        params += values
+    
+    for name, (col, op) in range_predicates.items():
+        if args[name] is None:
+            continue
+        # Premiered dates are stored as YYYY-MM-DD and compare as text, so
+        # other ISO forms (20150101, 2015-W01-1) are bound in that form too
+        value = args[name]
+        if col == 'premiered':
+            try:
+                value = dt.date.fromisoformat(value).isoformat()
+            except ValueError:
+                api.abort(404, f'{name} must be a date like 2021-03-21; got {args[name]}')
+        clauses.append(f'{quote(col)} {op} ?')
+        params.append(value)
+    
+    return ' AND '.join(clauses) or '1', params
+
+def check_update(update):
+    # Check the body of a PATCH, returning the column values it sets and
+    # None, or None and a (message, status code) for the first problem found.
+    # Genres aren't a column, so they're left in the update for save_genres.
+    if type(update) is not dict:
+        return None, (f'Update must be a dict; got {type(update)}', 400)
+    
+    for name in update.keys():
+        if name == 'id' or name == 'tvmaze-id':
+            return None, ('id and tvmaze-id cannot be changed', 400)
+        elif name == 'genres':
+            body = update[name]
+            if type(body) is not list or any(type(genre) is not str for genre in body):
+                return None, (f'Genres must be a list of strings; got {body}', 404)
+        elif name == 'schedule':
+            body = update[name]
+            if type(body) is not dict:
+                return None, (f'Schedule must be a dict; got {type(body)}', 404)
+            for name2 in body.keys():
+                if name2 not in ['time','days']:
+                    return None, ('Schedule must be a dict with time and days fields', 404)
+            # These are stored in typed columns, so check the values too
+            days = body.get('days')
+            if days is not None and (type(days) is not list or any(type(day) is not str for day in days)):
+                return None, (f'Schedule days must be a list of strings; got {days}', 404)
+            if type(body.get('time')) not in [str, type(None)]:
+                return None, (f'Schedule time must be a string; got {body["time"]}', 404)
+        elif name == 'rating':
+            body = update[name]
+            if type(body) is not dict:
+                return None, (f'Rating must be a dict; got {type(body)}', 404)
+            for name2 in body.keys():
+                if name2 != 'average':
+                    return None, ('Rating must be a dict with average field', 404)
+            if type(body.get('average')) not in [int, float, type(None)]:
+                return None, (f'Rating average must be a number; got {body["average"]}', 404)
+        elif name == 'network':
+            body = update[name]
+            if type(body) is not dict:
+                return None, (f'Network must be a dict; got {type(body)}', 404)
+            for name2 in body.keys():
+                if name2 not in ['id','name','country']:
+                    return None, ('Network must be a dict with id, name and country fields', 404)
+            if type(body.get('id')) not in [int, type(None)]:
+                return None, (f'Network id must be an integer; got {body["id"]}', 404)
+            if type(body.get('name')) not in [str, type(None)]:
+                return None, (f'Network name must be a string; got {body["name"]}', 404)
+            country = body.get('country')
+            if type(country) is dict:
+                if any(type(part) not in [str, type(None)] for part in country.values()):
+                    return None, (f'Network country must have string values; got {country}', 404)
+            elif type(country) not in [str, type(None)]:
+                return None, (f'Network country must be a dict or string; got {country}', 404)
+        elif name in ['name','type','language','status','premiered','officialSite','summary']:
+            if type(update[name]) not in [str, type(None)]:
+                return None, (f'{name} must be a string; got {update[name]}', 404)
+        elif name in ['runtime','weight']:
+            if type(update[name]) not in [int, type(None)]:
+                return None, (f'{name} must be an integer; got {update[name]}', 404)
+    
+    # Collect the new column values, to be written with a single UPDATE on
+    # the row (genres are replaced in their own table)
+    values = {}
+    
+    for key in update:
+        if key not in show_model.keys() or key not in detail_fields:
+            return None, (f'Property {key} is invalid', 400)
+        
+        if key in ['schedule','rating','network']:
+            values.update(flatten(key, update[key]))
+        elif key != 'genres':
+            values[key] = update[key]
+        
+        # The summary is searched without its HTML
+        if key == 'summary':
+            values['summary-text'] = strip_html(update[key])
+    
+    return values, None
 
 @api.route('/tv-shows', doc={'params': {'order_by': 'Field to order returned objects by; must begin with +/-, default is "id"',
                                          'page': 'Which page to return',
                                          'page_size': 'Size of pages',
-                                         'filter': 'Which columns to return'}})
+                                         'filter': 'Which columns to return',
+                                         'cursor': 'Cursor from a previous next/previous link; pass an empty cursor to start keyset pagination instead of using page',
+                                         'language': 'Only shows in these languages (comma separated)',
+                                         'genre': 'Only shows with any of these genres (comma separated)',
+                                         'status': 'Only shows with these statuses (comma separated), e.g. Running',
+                                         'type': 'Only shows of these types (comma separated)',
+                                         'network': 'Only shows on these networks (comma separated names)',
+                                         'premiered_from': 'Only shows premiered on or after this date (YYYY-MM-DD)',
+                                         'premiered_to': 'Only shows premiered on or before this date (YYYY-MM-DD)',
+                                         'min_rating': 'Only shows rated at least this',
+                                         'explain': 'In debug mode, set to 1 to include the query plan',
+                                         'ids': 'Comma separated ids of the shows to delete (DELETE only)'}})
 class ShowsList(Resource):
     
     @api.response(200, 'Successful')
+    @api.response(304, 'Not modified since the ETag given in If-None-Match')
     @api.doc(description='Get all filter elements of TV shows by order_by')
     def get(self):
         
@@ -180,9 +1306,10 @@ class ShowsList(Resource):
         parser.add_argument('page', type=int)
         parser.add_argument('page_size', type=int)
         parser.add_argument('filter', type=str)
-        
-        cnx = sqlite3.connect(database_file)
-        df = sql.read_sql('SELECT * FROM TV_Shows', cnx)
+        parser.add_argument('cursor', type=str)
+        for name in predicate_names:
+            parser.add_argument(name, type=float if name == 'min_rating' else str)
+        parser.add_argument('explain', type=int)
         
         # Get parameters of query and set default values where necessary
         args = parser.parse_args()
@@ -197,208 +1324,464 @@ class ShowsList(Resource):
             args['filter'] = 'id,name'    
             # args['filter'] = 'genres,rating,network,schedule'
         
-        # For order_by, split the string and add the +/- to asc list and
-        # the body to list order_by
+        # Pages are cached until the next write to the table; the key is the
+        # query with defaults filled in, so equivalent URLs share an entry
+        key = ('list', request.host, args['order_by'].replace('+', ' '), args['page'],
+               args['page_size'], args['filter'], args['cursor'],
+               tuple(args[name] for name in predicate_names), args['explain'])
+        
+        return cached_response(key, lambda: self.list_page(args))
+    
+    def list_page(self, args):
+        
+        # Wrong page format
+        if args['page'] <= 0:
+            api.abort(404, f'Page must be positive number; got {args["page"]}')
+        if args['page_size'] <= 0:
+            api.abort(404, f'Page size must be positive number; got {args["page_size"]}')
+        
+        # For order_by, split the string into (column, ascending) sort keys,
+        # checking each field is one we can sort by
         orderby_arg = args['order_by'].split(',')
         
-        order_by = []
-        asc = []
+        keys = []
+        canonical = []
         
         for name in orderby_arg:
             temp = name[1:]
             
             # No +/- at the beginning
-            if name[0] != ' ' and name[0] != '-' and name[0] != '+':
-                api.abort(404, f'order_by must begin with + or -; {name[0]} found')
-            # Wrong page format
-            if args['page'] <= 0:
-                api.abort(404, f'Page must be positive number; got {args["page"]}')
+            if name[:1] not in [' ','-','+']:
+                api.abort(404, f'order_by must begin with + or -; {name[:1]} found')
             # Incorrect order_by
-            if temp not in ['id','name','runtime','premiered','rating-average']:
+            if temp not in sortable:
                 api.abort(404, f'order_by must be either id,name,runtime,premiered, or rating-average; got {temp}')
             
-            # Make id the tvmaze-id
-            if temp == 'id':
-                order_by.append('tvmaze-id')
-            else:
-                order_by.append(temp)
-            
             # '+' is removed from the URL and replaced with ' ', so we just check for ' '
-            if name[0] == ' ' or name[0] == '+':
-                asc.append(True)
-            else:
-                asc.append(False)
-        
-        # If we're going by rating average, then extract the value in 'rating' column
-        if 'rating-average' in order_by:
-            def avg_rating(row):
-                row = row.split(':')
-                ret = row[1][:-1]
-                return ret
-        
-            df['rating-average'] = df['rating'].apply(avg_rating)
-        
-        # Sort values by order_by and asc, then drop index and create 'id' from 'tvmaze-id'
-        df = df.astype({'tvmaze-id': int,
-                        'runtime': float})
-
-        df = df.sort_values(by=order_by, ascending=asc)
+            keys.append((sortable[temp], name[0] == ' ' or name[0] == '+'))
+            canonical.append(('+' if keys[-1][1] else '-') + temp)
         
-        df.drop(columns=['index'], inplace=True)
+        # Cursors are tied to the ordering they were made for; compare on a
+        # normalised form since '+' may have arrived as ' '
+        canonical = ','.join(canonical)
         
-        df['id'] = df['tvmaze-id']        
+        # Always finish on the id so that every row has a unique position;
+        # it runs the same way as the last key so the (key, id) indexes apply
+        if 'tvmaze-id' not in [col for col, _ in keys]:
+            keys.append(('tvmaze-id', keys[-1][1]))
         
         # Split filters and check validity
-        filt = args['filter'].split(',')
-        
-        for filt_name in filt:
-            if filt_name not in df.columns:
-                api.abort(404, f'filter must be in the DB; got {filt_name}')
-        
-        # Keep only those columns in the df that are listed in filter, then
-        # check for the cols that need to be converted to JSON before being
-        # returned (i.e., those that are lists or dicts)        
-        df = df[filt]
-        
-        def json_it(row):
-            return json.loads(row)
-        
-        for col in df:
-            if col in['genres','schedule','rating','network']:
-                df[col] = df[col].apply(json_it)
+        filt = check_filter(args['filter'])
+        
+        # Sort keys are selected too so that cursors can be built from the
+        # first and last rows of the page
+        select = [quote(col) for col in field_columns(filt + [col for col, _ in keys])]
+        
+        predicates, predicate_params = check_predicates(args)
+        
+        # With a cursor we read forwards (or backwards, for previous links)
+        # from the boundary row instead of skipping over earlier pages
+        segments = [('1', [])]
+        direction = 'next'
+        keyset = args['cursor'] is not None
+        
+        if keyset and args['cursor'] != '':
+            decoded = decode_cursor(args['cursor'])
+            if decoded is None or decoded[0] != canonical or len(decoded[1]) != len(keys):
+                api.abort(404, f'cursor is not valid for order_by {args["order_by"]}; got {args["cursor"]}')
+            _, values, direction = decoded
+            if direction == 'prev':
+                keys = [(col, not asc) for col, asc in keys]
+            segments = keyset_after(keys, values)
+        
+        order_by = ', '.join(f'{quote(col)} {"ASC" if asc else "DESC"}' for col, asc in keys)
+        
+        # Fetch one row more than the page holds, which tells us whether
+        # there's a next page without having to count the whole table
+        start = 0 if keyset else (args['page'] - 1) * args['page_size']
+        
+        # In debug mode, ?explain=1 shows how SQLite runs each statement
+        explain = current_app.debug and bool(args['explain'])
+        plan = []
+        
+        cnx = get_db()
+        rows = []
+        for where, params in segments:
+            sql = (f'SELECT {", ".join(select)} FROM {table_name} WHERE ({where}) AND {predicates} '
+                   f'ORDER BY {order_by} LIMIT ? OFFSET ?')
+            params = params + predicate_params + [args['page_size'] + 1 - len(rows), start]
+            if explain:
+                plan += [step[3] for step in cnx.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+            rows += fetch_rows(cnx.execute(sql, params))
+            if len(rows) > args['page_size']:
+                break
+        
+        # If the starting record is already outside the bounds of the table
+        if len(rows) == 0 and not keyset and args['page'] > 1:
+            total = cnx.execute(f'SELECT COUNT(*) FROM {table_name} WHERE {predicates}',
+                                predicate_params).fetchone()[0]
+            api.abort(404, f'Database has a total of {total} records; max pages is {math.ceil(total / args["page_size"])}')
+        
+        has_more = len(rows) > args['page_size']
+        rows = rows[:args['page_size']]
+        if direction == 'prev':
+            rows.reverse()
+        
+        shows = build_shows(cnx, rows, filt)
+        
+        href = f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page_size={args["page_size"]}&filter={args["filter"]}'
+        
+        # Links keep the same predicates
+        narrowed = {name: args[name] for name in predicate_names if args[name] is not None}
+        if narrowed:
+            href += '&' + urlencode(narrowed)
         
-        # Check if the page_size value is larger than the df itself -- if it
-        # is then we only need to return one page, otherwise get the appropriate
-        # values based on page and page_size, then return along with links.        
         pages = {}
         
-        if args['page_size'] >= len(df) and args['page'] == 1:
+        if keyset:
+            links = {'self': {'href': f'{href}&cursor={args["cursor"]}'}}
+            
+            # Coming back from a later page means there's always a next page
+            # (and likewise a previous page once we've moved forwards)
+            has_next = has_more if direction == 'next' else True
+            has_prev = has_more if direction == 'prev' else args['cursor'] != ''
+            
+            if rows and has_next:
+                token = encode_cursor(canonical, [rows[-1][col] for col, _ in keys], 'next')
+                links['next'] = {'href': f'{href}&cursor={token}'}
+            if rows and has_prev:
+                token = encode_cursor(canonical, [rows[0][col] for col, _ in keys], 'prev')
+                links['previous'] = {'href': f'{href}&cursor={token}'}
+        else:
+            links = {'self': {'href': f'{href}&page={args["page"]}'}}
+            
+            if has_more:
+                links['next'] = {'href': f'{href}&page={args["page"] + 1}'}
+            if args['page'] > 1:
+                links['previous'] = {'href': f'{href}&page={args["page"] - 1}'}
+            
             pages['page'] = args['page']
-            pages['page_size'] = args['page_size']
-            pages['tv-shows'] = json.loads(df.to_json(orient='records'))
-            pages['_links'] = {'self': {
-                                'href': f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page={args["page"]}&page_size={args["page_size"]}&filter={args["filter"]}'}}
         
-        else:
+        pages['page_size'] = args['page_size']
+        pages['tv-shows'] = shows
+        pages['_links'] = links
+        if explain:
+            pages['_plan'] = plan
             
-            start = args['page'] * args['page_size']
-            end = (args['page'] + 1) * args['page_size']
+        return pages
+    
+    @api.response(200, 'Update finished; see results for each item')
+    @api.response(400, 'Validation error')
+    @api.doc(description='Update many TV shows at once. The body is a JSON list of {"id": ..., "fields": {...}}, '
+                         'where fields is what a PATCH of that one show would take. An item can also give the '
+                         '"version" of the show it was based on (the start of its ETag), to only be applied if '
+                         'the show is still at that version.')
+    def patch(self):
+        
+        body = request.get_json(silent=True)
+        if not isinstance(body, list):
+            return {'message': 'Body must be a JSON list of {"id": ..., "fields": {...}}'}, 400
+        
+        # Check every item the same way as a single PATCH, keeping the valid
+        # ones to write
+        results = []
+        valid = []
+        for item in body:
+            id = item.get('id') if isinstance(item, dict) else None
+            if type(id) is not int:
+                results.append({'id': id, 'status': 'invalid', 'message': 'Every item must have an integer id'})
+                continue
+            if item.get('version') is not None and type(item['version']) is not int:
+                results.append({'id': id, 'status': 'invalid', 'message': 'version must be an integer'})
+                continue
             
-            links = {'self': {
-                    'href': f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page={args["page"]}&page_size={args["page_size"]}&filter={args["filter"]}'}}
+            values, error = check_update(item.get('fields'))
+            if error is not None:
+                results.append({'id': id, 'status': 'invalid', 'message': error[0]})
+                continue
             
-            # If the starting record is already outside the bounds of the df
-            if start > len(df):
-                api.abort(404, f'Database has a total of {len(df)} records; max pages is {math.ceil(len(df) / args["page_size"])}')
+            results.append({'id': id, 'status': 'updated'})
+            valid.append((results[-1], values, item['fields'], item.get('version')))
+        
+        cnx = get_db()
+        updated = now()
+        
+        with cnx:
+            # Take the write lock before checking which shows exist, so none
+            # can be deleted between the check and the updates
+            cnx.execute('BEGIN IMMEDIATE')
+            have = row_versions(cnx, [result['id'] for result, _, _, _ in valid])
             
-            # If we're on the first page and there's more than one page
-            if args['page'] == 1 and len(df) > args['page_size']:
-                links['next'] = {'href': f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page={args["page"] + 1}&page_size={args["page_size"]}&filter={args["filter"]}'}
-            # If we're on the last page
-            elif end >= len(df):
-                links['previous'] = {'href': f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page={args["page"] - 1}&page_size={args["page_size"]}&filter={args["filter"]}'}
-            # All other cases
-            else:
-                links['next'] = {'href': f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page={args["page"] + 1}&page_size={args["page_size"]}&filter={args["filter"]}'}
-                links['previous'] = {'href': f'http://{request.host}/tv-shows?order_by={args["order_by"]}&page={args["page"] - 1}&page_size={args["page_size"]}&filter={args["filter"]}'}
-                
-            page_x = df[(start-1):(end-1)]
+            # Items for the same show are merged in order (so later ones win);
+            # versions are compared with the show as it was before the batch
+            merged = {}
+            for result, values, fields, version in valid:
+                if result['id'] not in have:
+                    result['status'] = 'not-found'
+                    continue
+                if version is not None and version != have[result['id']]:
+                    result['status'] = 'conflict'
+                    result['message'] = f'Show is now at version {have[result["id"]]}'
+                    continue
+                entry = merged.setdefault(result['id'], [{}, None])
+                entry[0].update(values)
+                if 'genres' in fields:
+                    entry[1] = fields['genres']
             
-            pages['page'] = args['page']
-            pages['page_size'] = args['page_size']
-            pages['tv-shows'] = json.loads(page_x.to_json(orient='records'))
-            pages['_links'] = links
+            # Then shows setting the same columns share one executemany
+            groups = {}
+            for id, (values, genres) in merged.items():
+                values['last-update'] = updated
+                groups.setdefault(tuple(values), []).append(list(values.values()) + [id])
+            for cols, params in groups.items():
+                assign = ', '.join(f'{quote(col)} = ?' for col in cols)
+                cnx.executemany(f'UPDATE {table_name} SET {assign}, "row-version" = "row-version" + 1 '
+                                f'WHERE "tvmaze-id" = ?', params)
             
-        return pages
+            genres = {id: genres for id, (_, genres) in merged.items() if genres is not None}
+            cnx.executemany('DELETE FROM Show_Genres WHERE show_id = ?', [(id,) for id in genres])
+            cnx.executemany('INSERT INTO Show_Genres (show_id, position, genre) VALUES (?, ?, ?)',
+                            [(id, position, genre) for id in genres for position, genre in enumerate(genres[id])])
+        
+        # Each show was bumped once, however many items it had
+        for result, _, _, _ in valid:
+            if result['status'] == 'updated':
+                result['version'] = have[result['id']] + 1
+        
+        to_ret = {'updated': len(merged),
+                  'last-update': updated,
+                  'results': results}
+        
+        return to_ret
+    
+    @api.response(200, 'Delete finished; see results for each id')
+    @api.response(400, 'Validation error')
+    @api.doc(description='Delete many TV shows at once, given as ?ids=1,2,3')
+    def delete(self):
+        
+        parser = reqparse.RequestParser()
+        parser.add_argument('ids', type=str, required=True)
+        
+        args = parser.parse_args()
+        
+        try:
+            ids = list(dict.fromkeys(int(id) for id in args['ids'].split(',')))
+        except ValueError:
+            return {'message': f'ids must be a comma separated list of ids; got {args["ids"]}'}, 400
+        
+        cnx = get_db()
+        
+        with cnx:
+            cnx.execute('BEGIN IMMEDIATE')
+            have = existing_ids(cnx, ids)
+            cnx.executemany(f'DELETE FROM {table_name} WHERE "tvmaze-id" = ?', [(id,) for id in ids if id in have])
+        
+        to_ret = {'deleted': len(have),
+                  'results': [{'id': id, 'status': 'deleted' if id in have else 'not-found'} for id in ids]}
+        
+        return to_ret
+
+@api.route('/tv-shows/export', doc={'params': {'format': 'ndjson (default) or csv',
+                                                'filter': 'Which columns to return, default is all of them'}})
+class ShowsExport(Resource):
+    
+    @api.response(200, 'Successful; the shows are streamed in id order')
+    @api.doc(description='Export every TV show as newline delimited JSON or CSV')
+    def get(self):
+        
+        parser = reqparse.RequestParser()
+        parser.add_argument('format', type=str)
+        parser.add_argument('filter', type=str)
+        
+        args = parser.parse_args()
+        if args['format'] is None:
+            args['format'] = 'ndjson'
+        if args['filter'] is None:
+            args['filter'] = ','.join(['id'] + detail_fields[1:])
+        
+        if args['format'] not in ['ndjson','csv']:
+            api.abort(404, f'FORMAT parameter must be either ndjson or csv; got {args["format"]}')
+        
+        filt = check_filter(args['filter'])
+        select = ', '.join(quote(col) for col in field_columns(filt))
+        
+        def encode(shows):
+            # One chunk of output for a batch of shows
+            if args['format'] == 'ndjson':
+                return b''.join(dumps(show) + b'\n' for show in shows)
+            
+            # Lists and objects don't fit in a CSV cell, so they go in as JSON
+            out = io.StringIO()
+            writer = csv.writer(out)
+            for show in shows:
+                writer.writerow([dumps(value).decode() if isinstance(value, (list, dict)) else value
+                                 for value in show.values()])
+            return out.getvalue().encode()
+        
+        # The body is sent after the request has finished (and the app
+        # context is gone), so take the app's db settings now
+        config = get_config('db')
+        
+        def generate():
+            # Read with our own connection, which stays open while the body is
+            # sent, a chunk of rows at a time so memory use stays flat
+            cnx = connect(config['database'], config)
+            try:
+                if args['format'] == 'csv':
+                    yield (','.join(filt) + '\r\n').encode()
+                
+                cur = cnx.execute(f'SELECT {select} FROM {table_name} ORDER BY "tvmaze-id"')
+                cols = [desc[0] for desc in cur.description]
+                while True:
+                    rows = cur.fetchmany(export_chunk)
+                    if not rows:
+                        break
+                    rows = [dict(zip(cols, row)) for row in rows]
+                    yield encode(build_shows(cnx, rows, filt))
+            finally:
+                cnx.close()
+        
+        mimetype = 'application/x-ndjson' if args['format'] == 'ndjson' else 'text/csv'
+        
+        return current_app.response_class(generate(), mimetype=mimetype,
+                                  headers={'Content-Disposition': f'attachment; filename=tv-shows.{args["format"]}'})
+
+@api.route('/tv-shows/search', doc={'params': {'q': 'Words to search show names and summaries for; the last word can be the start of a word',
+                                                'page': 'Which page to return',
+                                                'page_size': 'Size of pages',
+                                                'filter': 'Which columns to return'}})
+class ShowsSearch(Resource):
+    
+    @api.response(200, 'Successful; best matches first')
+    @api.response(304, 'Not modified since the ETag given in If-None-Match')
+    @api.doc(description='Search TV shows by name and summary')
+    def get(self):
+        
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', type=str, required=True)
+        parser.add_argument('page', type=int)
+        parser.add_argument('page_size', type=int)
+        parser.add_argument('filter', type=str)
+        
+        args = parser.parse_args()
+        if args['page'] is None:
+            args['page'] = 1
+        if args['page_size'] is None:
+            args['page_size'] = 100
+        if args['filter'] is None:
+            args['filter'] = 'id,name'
+        
+        key = ('search', request.host, args['q'], args['page'], args['page_size'], args['filter'])
+        
+        return cached_response(key, lambda: self.search_page(args))
+    
+    def search_page(self, args):
+        
+        if args['page'] <= 0:
+            api.abort(404, f'Page must be positive number; got {args["page"]}')
+        if args['page_size'] <= 0:
+            api.abort(404, f'Page size must be positive number; got {args["page_size"]}')
+        
+        filt = check_filter(args['filter'])
+        
+        # Every word has to match, either exactly or as the start of a word;
+        # quoting them keeps FTS5 from reading anything as query syntax
+        words = re.findall(r'\w+', args['q'])
+        if len(words) == 0:
+            api.abort(404, f'q must contain at least one word; got {args["q"]}')
+        match = ' '.join(f'"{word}"*' for word in words)
+        
+        # Best matches first, with a match in the name counting for more
+        # than one in the summary. One row extra tells us about a next page.
+        select = ', '.join(f'shows.{quote(col)}' for col in field_columns(filt))
+        
+        cnx = get_db()
+        cur = cnx.execute(f'SELECT {select} FROM Show_Search '
+                          f'JOIN {table_name} AS shows ON shows."tvmaze-id" = Show_Search.rowid '
+                          f'WHERE Show_Search MATCH ? ORDER BY bm25(Show_Search, 10.0, 1.0) LIMIT ? OFFSET ?',
+                          (match, args['page_size'] + 1, (args['page'] - 1) * args['page_size']))
+        rows = fetch_rows(cur)
+        
+        has_more = len(rows) > args['page_size']
+        shows = build_shows(cnx, rows[:args['page_size']], filt)
+        
+        # q is free text, so it's encoded to come back the same
+        query = urlencode({'q': args['q'], 'page_size': args['page_size'], 'filter': args['filter']}, safe=',')
+        href = f'http://{request.host}/tv-shows/search?{query}'
+        
+        links = {'self': {'href': f'{href}&page={args["page"]}'}}
+        if has_more:
+            links['next'] = {'href': f'{href}&page={args["page"] + 1}'}
+        if args['page'] > 1:
+            links['previous'] = {'href': f'{href}&page={args["page"] - 1}'}
+        
+        return {'q': args['q'],
+                'page': args['page'],
+                'page_size': args['page_size'],
+                'tv-shows': shows,
+                '_links': links}
 
 @api.route('/tv-shows/<int:id>')
 @api.param('id', 'The unique identifier for the TV show; same as the tvmaze ID')
 class Shows(Resource):
     
     @api.response(200, 'Successful')
-    @api.doc(description='Get a specific TV show based on its id')
+    @api.response(304, 'Not modified since the ETag given in If-None-Match')
+    @api.doc(description='Get a specific TV show based on its id. Its ETag can be given in If-Match to '
+                         'update or delete the show only if it hasn\'t changed since.')
     def get(self, id):
-        cnx = sqlite3.connect(database_file)
-        df = sql.read_sql('SELECT * FROM TV_Shows', cnx)
-        
-        # return df['name']
-        
-        df = df.astype({'tvmaze-id': int,
-                        'runtime': float})
-        df.sort_values(inplace=True, by='tvmaze-id', ascending=True, ignore_index=True)
+        return cached_response(('show', request.host, id), lambda: self.show(id), tagged=True)
+    
+    def show(self, id):
+        cnx = get_db()
         
-        ret = df.loc[df['tvmaze-id'] == id]
+        cur = cnx.execute(f'SELECT {", ".join(quote(col) for col in field_columns(detail_fields))}, "row-version" '
+                          f'FROM {table_name} WHERE "tvmaze-id" = ?', (id,))
+        rows = fetch_rows(cur)
+        ret = build_shows(cnx, rows, ['id'] + detail_fields)
         
         if len(ret) == 0:
             api.abort(404, f'Show with id {id} does not exist')
-            return
-        
-        ret = ret[['tvmaze-id',
-                    'name',
-                    'last-update',
-                    'type',
-                    'language',
-                    'genres',
-                    'status',
-                    'runtime',
-                    'premiered',
-                    'officialSite',
-                    'schedule',
-                    'rating',
-                    'weight',
-                    'network',
-                    'summary']]
-        
-        current = df.loc[df['tvmaze-id'] == id].index[0]
+        
+        to_ret = ret[0]
+        
+        # Work out the shows either side of this one, ordered by id; both are
+        # a single seek on the primary key
+        prev, nex = cnx.execute(f'SELECT (SELECT MAX("tvmaze-id") FROM {table_name} WHERE "tvmaze-id" < ?), '
+                                f'(SELECT MIN("tvmaze-id") FROM {table_name} WHERE "tvmaze-id" > ?)',
+                                (id, id)).fetchone()
         
         links = {'self': {'href': f'http://{request.host}/tv-shows/{id}'}}
         
-        if current == 0 and len(df) != 1:
-            nex = df['tvmaze-id'].iloc[current + 1]
-            links['next'] = {'href': f'http://{request.host}/tv-shows/{nex}'}
-        elif current == len(df) - 1:
-            prev = df['tvmaze-id'].iloc[(current - 1)]
+        if prev is not None:
             links['previous'] = {'href': f'http://{request.host}/tv-shows/{prev}'}
-        else:
-            nex = df['tvmaze-id'].iloc[current + 1]
+        if nex is not None:
             links['next'] = {'href': f'http://{request.host}/tv-shows/{nex}'}
-
-            prev = df['tvmaze-id'].iloc[(current - 1)]
-            links['previous'] = {'href': f'http://{request.host}/tv-shows/{prev}'}
-        
-        # return ret.loc[0,'tvmaze-id']
-        
-        to_ret = {'id': int(ret['tvmaze-id'][ret.index[0]])}
-        
-        for col in ret.columns:
-            if col in ['genres','schedule','rating','network']:
-                to_ret[col] = json.loads(ret[col][ret.index[0]])
-            elif col in ['tvmaze-id','runtime']:
-                try:
-                    to_ret[col] = int(ret[col][ret.index[0]])
-                except ValueError:
-                    to_ret[col] = None
-            else:
-                to_ret[col] = ret[col][ret.index[0]]
         
         to_ret['_links'] = links
         
-        return to_ret
+        # The row version starts the ETag, for If-Match
+        return to_ret, rows[0]['row-version']
     
     @api.response(200, 'Successfully deleted TV show')
     @api.response(404, 'TV show not found')
-    @api.doc(description='Delete a specific TV show based on its id')
+    @api.response(412, 'TV show has changed since the ETag given in If-Match')
+    @api.doc(description='Delete a specific TV show based on its id; with If-Match, only if it hasn\'t changed since')
     
     def delete(self, id):
-        cnx = sqlite3.connect(database_file)
-        df = sql.read_sql('SELECT * FROM TV_Shows', cnx)
+        cnx = get_db()
         
-        if len(df.loc[df['tvmaze-id'] == str(id)]) == 0:
-            api.abort(404, f'Show with id {id} does not exist')            
+        condition, params = version_condition(if_match_versions())
         
-        df = df.loc[df['tvmaze-id'] != str(id)]
+        with cnx:
+            cur = cnx.execute(f'DELETE FROM {table_name} WHERE "tvmaze-id" = ?{condition}', [id] + params)
+            # Nothing deleted: either it's gone, or it's changed since If-Match
+            changed = cur.rowcount == 0 and condition != '' and bool(existing_ids(cnx, [id]))
         
-        sql.to_sql(df, name='TV_Shows', con=cnx, if_exists='replace', index=False)
+        if changed:
+            api.abort(412, f'Show with id {id} has changed since the ETag given in If-Match')
+        if cur.rowcount == 0:
+            api.abort(404, f'Show with id {id} does not exist')            
         
         return {'message': f'The TV show with id {id} was removed from the database',
                 'id': f'{id}'}, 200 
@@ -406,76 +1789,104 @@ class Shows(Resource):
     @api.response(200, 'Successfully updated TV show')
     @api.response(404, 'TV show not found')
     @api.response(400, 'Validation error')
-    @api.doc(description='Update a specific TV show based on its id')
+    @api.response(412, 'TV show has changed since the ETag given in If-Match')
+    @api.doc(description='Update a specific TV show based on its id; with If-Match, only if it hasn\'t changed since')
     @api.expect(show_model)
     def patch(self, id):
         
-        cnx = sqlite3.connect(database_file)
-        df = sql.read_sql('SELECT * FROM TV_Shows', cnx)
+        cnx = get_db()
         
-        show = df.loc[df['tvmaze-id'] == str(id)]
+        show = cnx.execute(f'SELECT 1 FROM {table_name} WHERE "tvmaze-id" = ?', (id,)).fetchone()
         
-        if len(show) == 0:
+        if show is None:
             api.abort(404, f'Show with id {id} does not exist')
         
         update = request.json
         
-        for name in update.keys():
-            if name == 'id' or name == 'tvmaze-id':
-                return {'message': 'id and tvmaze-id cannot be changed'}, 400
-            elif name == 'genres':
-                body = update[name]
-                if type(body) is not list:
-                    api.abort(404, f'Genres must be a list; got {type(body)}')
-            elif name == 'schedule':
-                body = update[name]
-                if type(body) is not dict:
-                    api.abort(404, f'Schedule must be a dict; got {type(body)}')
-                for name2 in body.keys():
-                    if name2 not in ['time','days']:
-                        api.abort(404, 'Schedule must be a dict with time and days fields')
-            elif name == 'rating':
-                body = update[name]
-                if type(body) is not dict:
-                    api.abort(404, f'Rating must be a dict; got {type(body)}')
-                for name2 in body.keys():
-                    if name2 != 'average':
-                        api.abort(404, 'Rating must be a dict with average field')
-            elif name == 'network':
-                body = update[name]
-                if type(body) is not dict:
-                    api.abort(404, f'Network must be a dict; got {type(body)}')
-                for name2 in body.keys():
-                    if name2 not in ['id','name','country']:
-                        api.abort(404, 'Network must be a dict with id, name and country fields')
-        
-        # Because tvmaze-id is not the index, we find its index value
-        idx = (df.loc[df['tvmaze-id'] == str(id)]).index[0]
-        
-        for key in update:
-            if key not in show_model.keys():
-                return {'message': f'Property {key} is invalid'}, 400
-            
-            if key in ['genres','schedule','rating','network']:
-                dumped = json.dumps(update[key])
-                df.loc[idx,key] = dumped
-            else:
-                df.loc[idx,key] = update[key]
+        values, error = check_update(update)
+        if error is not None:
+            message, code = error
+            if code == 404:
+                api.abort(404, message)
+            return {'message': message}, code
+        
+        updated = now()
         
-        updated = str(dt.datetime.now() - dt.timedelta(microseconds=dt.datetime.now().microsecond))
+        values['last-update'] = updated
         
-        df.loc[idx,'last-update'] = updated
+        assign = ', '.join(f'{quote(col)} = ?' for col in values)
         
-        sql.to_sql(df, name='TV_Shows', con=cnx, if_exists='replace', index=False)
+        # With If-Match, the UPDATE only applies to the version the client
+        # had; otherwise someone else has changed (or deleted) it since
+        condition, params = version_condition(if_match_versions())
+        
+        with cnx:
+            cur = cnx.execute(f'UPDATE {table_name} SET {assign}, "row-version" = "row-version" + 1 '
+                              f'WHERE "tvmaze-id" = ?{condition}', list(values.values()) + [id] + params)
+            if cur.rowcount == 0:
+                if existing_ids(cnx, [id]):
+                    api.abort(412, f'Show with id {id} has changed since the ETag given in If-Match')
+                api.abort(404, f'Show with id {id} does not exist')
+            if 'genres' in update:
+                save_genres(cnx, id, update['genres'])
+            version = row_versions(cnx, [id])[id]
         
         to_ret = {'id': id,
                   'last-update': updated,
+                  'version': version,
                   '_links': {
                       'self': {
                           'href': f'http://{request.host}/tv-shows/{id}'}}}
         
         return to_ret
 
+# TVMaze clients, one for each set of settings in use
+_upstream = {}
+_upstream_lock = threading.Lock()
+
+
+def get_upstream():
+    # The TVMaze client for the current settings, shared by all threads so
+    # that they share its connections and response cache
+    config = get_config('tvmaze')
+    key = tuple(sorted(config.items()))
+    with _upstream_lock:
+        if key not in _upstream:
+            backend = tvmaze.HTTPBackend(config['url'], timeout=config['timeout'])
+            if config['fixtures'] is not None:
+                backend = tvmaze.FixtureBackend(config['fixtures'], record=backend if config['record'] else None)
+            _upstream[key] = tvmaze.Client(backend,
+                                           retries=config['retries'],
+                                           backoff=config['backoff'],
+                                           cache_size=config['cache_size'],
+                                           cache_ttl=config['cache_ttl'])
+        return _upstream[key]
+
+
+def search_show(name, client=None):
+    # Look a show up on TVMaze by name, returning the first exact
+    # (case-insensitive) match or None. Off the request's thread, pass in
+    # the app's client, as get_upstream needs the app.
+    start = time.perf_counter()
+    try:
+        results = (client or get_upstream()).search_shows(name)
+    finally:
+        seconds = time.perf_counter() - start
+        tvmaze_seconds.observe(seconds, 'search')
+        add_phase('tvmaze', seconds)
+    
+    for result in results:
+        show = result.get('show') or {}
+        if (show.get('name') or '').lower() == name.lower():
+            return show
+    return None
+
+
+def now():
+    # Timestamp used for last-update, to the second
+    return str(dt.datetime.now().replace(microsecond=0))
+
+
 importer = reqparse.RequestParser()
 importer.add_argument('name', type=str, required=True)
 
@@ -498,60 +1909,40 @@ class ShowsImport(Resource):
             api.abort(404, 'POST requires a name key')
         
         name = name['name']
-
-        if ' ' in name:
-            temp = name.split()
-            new_name = ''
-            for word in temp:
-                new_name += word + '%20'
-        else:
-            new_name = name
-            
-        # Read JSON data into a dataframe and convert dict column 'show' to columns
-        df = pd.read_json(f'http://api.tvmaze.com/search/shows?q={new_name}', orient='records')
         
-        df = pd.concat([df.drop(['show'], axis=1), df['show'].apply(pd.Series)], axis=1)
-        
-        # Check if the exact match of the show exists in the extracted data
-        df = df.loc[df['name'].str.lower() == name.lower()]
+        # Look the show up on TVMaze, which needs an exact match
+        try:
+            show = search_show(name)
+        except tvmaze.TVMazeError as err:
+            api.abort(502, str(err))
         
         # In case show doesn't exist
-        if len(df) == 0:
+        if show is None:
             api.abort(404, f'Show {name} does not exist.')
         
-        # Set 'tvmaze-id' as show id (since it's already set by tvmaze-id)        
-        df.rename(columns={'id': 'tvmaze-id'}, inplace=True)
-        
-        # Drop columns and set the remainder in the correct order for DB storage
-        df = df[['tvmaze-id','name','type','language',
-                 'genres','status','runtime','premiered',
-                 'officialSite','schedule','rating','weight','network',
-                 'summary']]
-        
-        # Some columns have an invalid type for DB storage (list and dict), so
-        # we convert them to strings (and when we extract them they're reverted
-        # with 'json.loads()'
-        df['genres'] = json.dumps(df['genres'][0])
-        df['schedule'] = json.dumps(df['schedule'][0])
-        df['rating'] = json.dumps(df['rating'][0])
-        df['network'] = json.dumps(df['network'][0])
+        # Split the nested fields out into the columns we store
+        values, genres = show_values(show)
         
         # Date and time added
-        added = str(dt.datetime.now() - dt.timedelta(microseconds=dt.datetime.now().microsecond))
+        added = now()
         
-        df['last-update'] = added
+        values['last-update'] = added
         
-        # Check if show already exists in DB -- if so, exit
-        cnx = sqlite3.connect('storage.db')
-        check_dup = sql.read_sql(f'select * from TV_Shows where "tvmaze-id" = "{df["tvmaze-id"][0]}"', cnx)
-        
-        if len(check_dup) == 0:
-            sql.to_sql(df, name='TV_Shows', con=cnx, if_exists='append', index=False)
-        else:
-            api.abort(404, f'Show {name} already exists in the database.')
+        # Check if show already exists in DB -- if so, exit. The write lock
+        # is taken first, so no other import can add it in between.
+        cnx = get_db()
+        with cnx:
+            cnx.execute('BEGIN IMMEDIATE')
+            check_dup = cnx.execute(f'SELECT 1 FROM {table_name} WHERE "tvmaze-id" = ?',
+                                    (values['tvmaze-id'],)).fetchone()
+            
+            if check_dup is None:
+                insert_shows(cnx, [(values, genres)])
+            else:
+                api.abort(404, f'Show {name} already exists in the database.')
         
         # Format our returning dict and return the object
-        tv_id = int(df['tvmaze-id'][0])
+        tv_id = values['tvmaze-id']
         
         to_ret = {'id': tv_id,
                   'last-update': added,
@@ -561,22 +1952,161 @@ class ShowsImport(Resource):
         return to_ret, 201
 
 
-if __name__ == '__main__':
-    table_name = 'TV_Shows'
-    database_file = 'storage.db'
+@api.route('/tv-shows/import/bulk')
+class ShowsBulkImport(Resource):
     
-    # Check current directory for DB -- create if it doesn't exist
-    if database_file not in os.listdir():    
-        schema = pd.DataFrame(columns=['tvmaze-id','name','type','language',
-                                       'genres','status','runtime','premiered',
-                                       'officialSite','schedule','rating','weight','network',
-                                       'summary','last-update'])
+    @api.response(200, 'Import finished; see results for each name')
+    @api.response(201, 'At least one TV show created')
+    @api.response(400, 'Validation error')
+    @api.doc(description='Import many tv shows from the TVMaze API at once. The body is either a JSON list of '
+                         'names (or {"names": [...]}), or JSON lines with one name (or {"name": ...}) per line.')
+    def post(self):
         
-        cnx = sqlite3.connect(database_file)
-        sql.to_sql(schema, name=table_name, con=cnx)
+        # Work out the names from whichever form the body came in
+        try:
+            if request.mimetype == 'application/json':
+                body = request.get_json()
+                if isinstance(body, dict):
+                    body = body.get('names')
+            else:
+                body = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            return {'message': 'Body must be a JSON list of names or JSON lines'}, 400
+        
+        if not isinstance(body, list):
+            return {'message': 'Body must be a JSON list of names or JSON lines'}, 400
+        
+        names = []
+        for item in body:
+            if isinstance(item, dict):
+                item = item.get('name')
+            if not isinstance(item, str) or item.strip() == '':
+                return {'message': f'Every name must be a non-empty string; got {item}'}, 400
+            names.append(item)
+        
+        # Each name is only looked up once, however many times it's listed
+        unique = list({name.lower(): name for name in reversed(names)}.values())[::-1]
+        
+        # Search for every name at once, a bounded number at a time
+        client = get_upstream()
+        
+        def lookup(name):
+            try:
+                return name, search_show(name, client), None
+            except Exception as err:
+                return name, None, str(err)
+        
+        # (The lookups run on other threads, so time them all here)
+        with phase('tvmaze'), ThreadPoolExecutor(max_workers=get_config('tvmaze')['workers']) as pool:
+            found = list(pool.map(lookup, unique))
+        
+        # Check which shows we already have in one go, then add the rest in
+        # a single transaction. The write lock is taken before the check, so
+        # a concurrent import can't add the same show in between.
+        cnx = get_db()
+        added = now()
+        
+        outcomes = {}
+        new = {}
+        with cnx:
+            cnx.execute('BEGIN IMMEDIATE')
+            have = existing_ids(cnx, [show['id'] for _, show, _ in found if show is not None])
+            
+            for name, show, error in found:
+                if error is not None:
+                    outcome = {'name': name, 'status': 'error', 'message': error}
+                elif show is None:
+                    outcome = {'name': name, 'status': 'not-found', 'message': f'Show {name} does not exist.'}
+                elif show['id'] in have or show['id'] in new:
+                    outcome = {'name': name, 'status': 'exists', 'id': show['id'],
+                               'message': f'Show {name} already exists in the database.'}
+                else:
+                    values, genres = show_values(show)
+                    values['last-update'] = added
+                    new[show['id']] = (values, genres)
+                    outcome = {'name': name, 'status': 'created', 'id': show['id'], 'last-update': added,
+                               '_links': {'self': {'href': f'http://{request.host}/tv-shows/{show["id"]}'}}}
+                outcomes[name.lower()] = outcome
+            
+            insert_shows(cnx, list(new.values()))
+        
+        # A result for every name given, in order; a name listed again gets
+        # a duplicate result pointing back at the first
+        results = []
+        seen = set()
+        for name in names:
+            outcome = outcomes[name.lower()]
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                results.append(outcome)
+            else:
+                results.append({'name': name, 'status': 'duplicate', 'id': outcome.get('id'),
+                                'message': f'Show {name} was already given as {outcome["name"]}.'})
+        
+        to_ret = {'created': len(new),
+                  'results': results}
+        
+        return to_ret, 201 if new else 200
+
+
+@api.route('/metrics')
+class Metrics(Resource):
+    
+    @api.response(200, 'Successful')
+    @api.doc(description='Request, SQL and TVMaze timings for this process, in the Prometheus text format')
+    def get(self):
+        return current_app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Settings create_app takes from its config, or otherwise from API_DEMO_<name>
+# environment variables, and the setting (see get_config) each one overrides
+app_settings = {'DATABASE': ('db', 'database', str),
+                'RESPONSE_CACHE_SIZE': ('cache', 'responses', int),
+                'TVMAZE_URL': ('tvmaze', 'url', str),
+                'TVMAZE_WORKERS': ('tvmaze', 'workers', int),
+                'TVMAZE_CACHE_SIZE': ('tvmaze', 'cache_size', int),
+                'TVMAZE_CACHE_TTL': ('tvmaze', 'cache_ttl', float),
+                'TVMAZE_FIXTURES': ('tvmaze', 'fixtures', str),
+                'SNAPSHOT': ('snapshot', 'enabled', lambda value: str(value).lower() in ['1', 'true', 'yes', 'on'])}
+
+
+def create_app(config=None):
+    # Make the Flask app, applying any settings given and creating the DB (or
+    # bringing an older one up to date). Under a multi-process server, call
+    # this once before forking (e.g. gunicorn --preload); see the README.
+    # Each app keeps its own copy of the settings, starting from the
+    # module's, so making another app never changes this one
+    config = dict(config or {})
+    settings = {'db': dict(db_config),
+                'tvmaze': dict(tvmaze_config),
+                'cache': dict(cache_config),
+                'snapshot': dict(snapshot_config)}
+    for name, (group, key, kind) in app_settings.items():
+        value = config.get(name, os.environ.get(f'API_DEMO_{name}'))
+        if value is not None:
+            settings[group][key] = kind(value)
+
+    app = Flask(__name__)
+    app.config.update(config)
+    app.extensions['api_demo'] = settings
+    api.init_app(app)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_appcontext(end_request)
+
+    with app.app_context():
+        init_db(get_db())
+        if settings['snapshot']['enabled']:
+            snapshot_group('language', 'count', None)
+        close_db()
+
+    return app
+
+
+if __name__ == '__main__':
+    # Development server only; the DB is in the current directory unless
+    # API_DEMO_DATABASE says otherwise
+    app = create_app()
 
     # NOTE: host and port are both hard-coded, as without hard-coding this
     # caused an error on CSE machines
     app.run(host='127.0.0.1', port=5000, debug=True)
-
-    
\ No newline at end of file
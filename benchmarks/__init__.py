@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for API_Demo.
+
+generate makes a storage.db-shaped database of synthetic shows, at any size
+(the usual ones being 1k, 100k and 1M rows), and run times scripted requests
+through Flask's test client against a copy of it, writing the results to
+JSON so runs can be compared between commits:
+
+    python -m benchmarks.generate --rows 100000
+    python -m benchmarks.run --rows 100000 --out results.json
+
+"""
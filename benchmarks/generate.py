@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Make a database of synthetic shows for benchmarking.
+
+Shows are generated as TVMaze returns them and stored through the same
+functions as imports, so the database has the same layout, indexes and
+derived tables as a real storage.db. The same seed always gives the same
+shows.
+
+"""
+
+import os
+import random
+import argparse
+
+import API_Demo as demo
+
+
+sizes = {'1k': 1000, '100k': 100000, '1m': 1000000}
+
+# Databases are kept here between runs, as the large ones take a while
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+languages = ['English'] * 12 + ['Japanese'] * 3 + ['Spanish'] * 2 + ['French', 'German', 'Korean', 'Chinese',
+                                                                     'Hindi', 'Portuguese', 'Russian', 'Dutch']
+statuses = ['Ended'] * 5 + ['Running'] * 3 + ['To Be Determined', 'In Development']
+types = ['Scripted'] * 6 + ['Reality'] * 2 + ['Animation', 'Documentary', 'Talk Show', 'Game Show',
+                                               'News', 'Sports', 'Variety', 'Award Show', 'Panel Show']
+genres = ['Drama', 'Comedy', 'Action', 'Crime', 'Thriller', 'Adventure', 'Horror', 'Romance',
+          'Science-Fiction', 'Fantasy', 'Mystery', 'Family', 'Children', 'Anime', 'History',
+          'Music', 'Medical', 'Legal', 'Supernatural', 'War', 'Western', 'Sports', 'Food']
+days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+countries = [('United States', 'US', 'America/New_York'), ('United Kingdom', 'GB', 'Europe/London'),
+             ('Japan', 'JP', 'Asia/Tokyo'), ('Canada', 'CA', 'America/Halifax'),
+             ('Germany', 'DE', 'Europe/Berlin'), ('France', 'FR', 'Europe/Paris'),
+             ('Australia', 'AU', 'Australia/Sydney'), ('Korea, Republic of', 'KR', 'Asia/Seoul')]
+words = ('the of and a night house city last dark blue game story life world man woman family '
+         'secret lost king queen love war street doctor police island river star fire time '
+         'little great new old wild black red golden high summer winter ghost dream heart').split()
+
+
+def networks(rng, count=300):
+    # A fixed set of networks for the shows to be spread over
+    out = []
+    for id in range(1, count + 1):
+        name, code, timezone = rng.choice(countries)
+        out.append({'id': id,
+                    'name': f'{rng.choice(words).title()} {rng.choice(["TV", "Network", "One", "Channel", "Plus"])} {id}',
+                    'country': {'name': name, 'code': code, 'timezone': timezone}})
+    return out
+
+
+def make_show(rng, id, network_list):
+    # One show, shaped like a TVMaze /shows/<id> response
+    title = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 4))).title()
+    summary = ' '.join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+    rating = None if rng.random() < 0.2 else round(rng.uniform(1, 10), 1)
+
+    return {'id': id,
+            'name': f'{title} {id}',
+            'type': rng.choice(types),
+            'language': rng.choice(languages),
+            'genres': rng.sample(genres, rng.randint(0, 3)),
+            'status': rng.choice(statuses),
+            'runtime': rng.choice([None, 15, 22, 30, 45, 60, 90]),
+            'premiered': None if rng.random() < 0.05 else
+                         f'{rng.randint(1950, 2023)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'officialSite': f'https://example.com/shows/{id}' if rng.random() < 0.5 else None,
+            'schedule': {'time': rng.choice(['', '20:00', '21:00', '22:00']),
+                         'days': sorted(rng.sample(days, rng.randint(0, 2)), key=days.index)},
+            'rating': {'average': rating},
+            'weight': rng.randint(0, 100),
+            'network': None if rng.random() < 0.1 else rng.choice(network_list),
+            'summary': f'<p><b>{title}</b> {summary}.</p>',
+            'updated': 1600000000 + rng.randint(0, 100000000)}
+
+
+def make_shows(count, start=1, seed=0):
+    # 'count' shows with ids from 'start'; a show's content depends only on
+    # the seed and its id, so ranges can be made separately
+    network_list = networks(random.Random(seed))
+    for id in range(start, start + count):
+        yield make_show(random.Random(seed * 1000003 + id), id, network_list)
+
+
+def generate(database, rows, seed=0, batch_size=10000):
+    # Create (or add to) a database with 'rows' shows
+    cnx = demo.connect(database)
+    try:
+        demo.init_db(cnx)
+        have = cnx.execute(f'SELECT COUNT(*) FROM {demo.table_name}').fetchone()[0]
+        stamp = '2021-03-21 20:58:06'
+
+        batch = []
+        for show in make_shows(rows - have, start=have + 1, seed=seed):
+            values, show_genres = demo.show_values(show)
+            values['last-update'] = stamp
+            batch.append((values, show_genres))
+            if len(batch) == batch_size:
+                with cnx:
+                    demo.insert_shows(cnx, batch)
+                batch = []
+        if batch:
+            with cnx:
+                demo.insert_shows(cnx, batch)
+
+        cnx.execute('ANALYZE')
+        cnx.commit()
+    finally:
+        cnx.close()
+
+
+def database_for(rows, seed=0):
+    # Path of the kept database with 'rows' shows, generating it if need be
+    database = os.path.join(data_dir, f'shows-{rows}-{seed}.db')
+    if not os.path.exists(database):
+        os.makedirs(data_dir, exist_ok=True)
+        generate(database + '.tmp', rows, seed=seed)
+        os.replace(database + '.tmp', database)
+    return database
+
+
+def rows_arg(value):
+    return sizes.get(value.lower()) or int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=rows_arg, default='100k', help='Number of shows, or one of 1k, 100k, 1m')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='Database to write; default is one kept in benchmarks/data')
+    args = parser.parse_args()
+
+    if args.db:
+        generate(args.db, args.rows, seed=args.seed)
+        print(args.db)
+    else:
+        print(database_for(args.rows, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Time scripted requests to every endpoint through Flask's test client.
+
+Each run works on a fresh copy of a generated database (see generate), and
+bulk imports are served by recorded TVMaze responses, so nothing goes over
+the network. A worker's cold start (import time, making the app and peak
+memory) is measured in a fresh interpreter first. The response and chart
+caches are emptied before every request unless --warm is given, so by
+default the figures are for doing the work. Results are written as JSON,
+along with the commit they were measured at.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+import datetime as dt
+from urllib.parse import urlencode
+
+import API_Demo as demo
+import tvmaze
+from benchmarks import generate
+
+
+# Shows for bulk imports get ids after those in the database
+bulk_size = 20
+# Shows changed by each batch PATCH or DELETE
+batch_size = 100
+
+
+def list_shallow(ctx, i):
+    return ctx.client.get('/tv-shows?page=1&page_size=100&filter=id,name,genres,rating,network'), 200
+
+def list_deep(ctx, i):
+    # The last page, by page number: everything before it is skipped over
+    last = max(1, -(-ctx.rows // 100))
+    return ctx.client.get(f'/tv-shows?page={last}&page_size=100&filter=id,name,genres,rating,network'), 200
+
+def list_deep_cursor(ctx, i):
+    # The same depth with a cursor
+    cursor = demo.encode_cursor('+id', [max(0, ctx.rows - 100)], 'next')
+    return ctx.client.get(f'/tv-shows?cursor={cursor}&page_size=100&filter=id,name,genres,rating,network'), 200
+
+def list_sorted(ctx, i):
+    return ctx.client.get('/tv-shows?order_by=-rating-average&page=3&page_size=100&filter=id,name,rating'), 200
+
+def list_filtered(ctx, i):
+    return ctx.client.get('/tv-shows?language=English&status=Running&genre=Drama&page_size=100&filter=id,name,genres'), 200
+
+def search(ctx, i):
+    return ctx.client.get(f'/tv-shows/search?q={ctx.rng.choice(generate.words)}&page_size=20'), 200
+
+def show(ctx, i):
+    return ctx.client.get(f'/tv-shows/{ctx.rng.randint(1, ctx.rows)}'), 200
+
+def stats_json(ctx, i):
+    by = ['language', 'genres', 'status', 'type'][i % 4]
+    return ctx.client.get(f'/tv-shows/statistics?format=json&by={by}'), 200
+
+def stats_image(ctx, i):
+    by = ['language', 'genres', 'status', 'type'][i % 4]
+    return ctx.client.get(f'/tv-shows/statistics?format=image&by={by}'), 200
+
+def stats_grouped(ctx, i):
+    query = ['by=network&metric=mean-rating', 'by=genres&metric=share',
+             'by=runtime&width=30', 'by=country&metric=mean-runtime'][i % 4]
+    return ctx.client.get(f'/tv-shows/statistics?{query}'), 200
+
+def patch(ctx, i):
+    return ctx.client.patch(f'/tv-shows/{ctx.rng.randint(1, ctx.rows)}',
+                            json={'name': f'Renamed {i}', 'rating': {'average': 5.5}}), 200
+
+def delete(ctx, i):
+    return ctx.client.delete(f'/tv-shows/{ctx.deletable.pop()}'), 200
+
+def batch_patch(ctx, i):
+    items = [{'id': ctx.rng.randint(1, ctx.rows), 'fields': {'name': f'Renamed {i}', 'genres': ['Drama']}}
+             for _ in range(batch_size)]
+    return ctx.client.patch('/tv-shows', json=items), 200
+
+def batch_delete(ctx, i):
+    # On a small database some of these will already have gone
+    ids = ctx.rng.sample(range(1, ctx.rows + 1), min(batch_size, ctx.rows))
+    return ctx.client.delete(f'/tv-shows?ids={",".join(map(str, ids))}'), 200
+
+def bulk_import(ctx, i):
+    names = [show['name'] for show in ctx.importable[i * bulk_size:(i + 1) * bulk_size]]
+    return ctx.client.post('/tv-shows/import/bulk', json=names), 201
+
+
+# In the order they're run; reads come first, while the data is as generated
+scenarios = {'list_shallow': list_shallow,
+             'list_deep': list_deep,
+             'list_deep_cursor': list_deep_cursor,
+             'list_sorted': list_sorted,
+             'list_filtered': list_filtered,
+             'search': search,
+             'show': show,
+             'stats_json': stats_json,
+             'stats_image': stats_image,
+             'stats_grouped': stats_grouped,
+             'patch': patch,
+             'delete': delete,
+             'batch_patch': batch_patch,
+             'batch_delete': batch_delete,
+             'bulk_import': bulk_import}
+
+
+class Context:
+    def __init__(self, client, rows, repeat, seed):
+        self.client = client
+        self.rows = rows
+        self.rng = random.Random(seed)
+        self.deletable = self.rng.sample(range(1, rows + 1), min(rows, repeat))
+        self.importable = list(generate.make_shows(repeat * bulk_size, start=rows + 1, seed=seed))
+
+
+def write_fixtures(directory, shows):
+    # Recorded TVMaze searches that find each of the shows
+    backend = tvmaze.FixtureBackend(directory)
+    os.makedirs(directory, exist_ok=True)
+    for show in shows:
+        with open(backend.filename('/search/shows', urlencode({'q': show['name']})), 'w') as f:
+            json.dump({'status': 200, 'body': [{'score': 1.0, 'show': show}]}, f)
+
+
+def summarise(times):
+    # Milliseconds, from a list of seconds
+    times = sorted(t * 1000 for t in times)
+    return {'requests': len(times),
+            'mean_ms': round(sum(times) / len(times), 3),
+            'median_ms': round(times[len(times) // 2], 3),
+            'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+            'min_ms': round(times[0], 3),
+            'max_ms': round(times[-1], 3)}
+
+
+# Run in a fresh interpreter to time a worker's cold start: importing the
+# module, then making the app, and the peak memory by the end of it
+startup_code = """
+import sys, json, time
+start = time.perf_counter()
+import API_Demo
+imported = time.perf_counter()
+API_Demo.create_app({'DATABASE': sys.argv[1]})
+created = time.perf_counter()
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / 1048576 if sys.platform == 'darwin' else rss / 1024
+except ImportError:
+    rss = None
+print(json.dumps({'import_ms': round((imported - start) * 1000, 3),
+                  'create_app_ms': round((created - imported) * 1000, 3),
+                  'max_rss_mb': None if rss is None else round(rss, 1),
+                  'pandas_imported': 'pandas' in sys.modules,
+                  'matplotlib_imported': 'matplotlib' in sys.modules}))
+"""
+
+
+def startup(database):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', startup_code, database], capture_output=True,
+                         text=True, cwd=root, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(rows, repeat=50, seed=0, warm=False, only=None):
+    source = generate.database_for(rows, seed=seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'storage.db')
+        shutil.copy(source, database)
+        cold = startup(database)
+
+        app = demo.create_app({'DATABASE': database, 'TVMAZE_FIXTURES': os.path.join(tmp, 'fixtures')})
+        ctx = Context(app.test_client(), rows, repeat, seed)
+        write_fixtures(os.path.join(tmp, 'fixtures'), ctx.importable)
+
+        results = {}
+        for name, scenario in scenarios.items():
+            if only and name not in only:
+                continue
+
+            times = []
+            for i in range(repeat):
+                if not warm:
+                    demo.response_cache.clear()
+                    demo.chart_cache.clear()
+                start = time.perf_counter()
+                response, expected = scenario(ctx, i)
+                times.append(time.perf_counter() - start)
+                if response.status_code != expected:
+                    raise RuntimeError(f'{name} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+            results[name] = summarise(times)
+
+        demo.close_all()
+
+    return {'commit': commit(),
+            'date': dt.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'orjson': demo.orjson is not None,
+            'rows': rows,
+            'seed': seed,
+            'repeat': repeat,
+            'warm': warm,
+            'startup': cold,
+            'scenarios': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=generate.rows_arg, default='100k', help='Number of shows, or one of 1k, 100k, 1m')
+    parser.add_argument('--repeat', type=int, default=50, help='Requests timed per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warm', action='store_true', help="Keep the response caches between requests")
+    parser.add_argument('--scenario', action='append', choices=list(scenarios), help='Run just this scenario (can be repeated)')
+    parser.add_argument('--out', help='Write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.rows, repeat=args.repeat, seed=args.seed, warm=args.warm, only=args.scenario)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
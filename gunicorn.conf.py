@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings for serving API_Demo across several processes:
+
+    gunicorn -c gunicorn.conf.py
+
+Settings for the app itself (the DB file and so on) come from API_DEMO_*
+environment variables; see the README.
+
+"""
+
+import os
+import multiprocessing
+
+wsgi_app = 'API_Demo:create_app()'
+bind = os.environ.get('API_DEMO_BIND', '127.0.0.1:5000')
+
+# SQLite in WAL mode lets every process read at once (writes still take
+# turns), so scale reads with a process or two per core
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2))
+threads = int(os.environ.get('API_DEMO_THREADS', 4))
+
+# Make the app (and create or migrate the DB) once, before forking
+preload_app = True
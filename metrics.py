@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Histograms for API_Demo's /metrics endpoint, kept in memory and written out
+in the Prometheus text format.
+
+Each process keeps its own figures, so under a multi-process server every
+worker reports separately (Prometheus adds them up per instance).
+
+"""
+
+import threading
+
+
+# Upper bounds of the buckets, in seconds, for whole requests and for the
+# much shorter SQL statements
+request_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+sql_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5, 1)
+
+
+def escape(value):
+    # Label values are quoted, so escape what would end them early
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=request_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+        # For each set of label values: [count per bucket, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+
+        with self._lock:
+            series = sorted((labels, [list(counts), total, count])
+                            for labels, (counts, total, count) in self._series.items())
+
+        for labels, (counts, total, count) in series:
+            pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.labels, labels)]
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = 'le="' + number(bound) + '"'
+                lines.append(f'{self.name}_bucket{{{",".join(pairs + [le])}}} {cumulative}')
+            suffix = f'{{{",".join(pairs)}}}' if pairs else ''
+            lines.append(f'{self.name}_sum{suffix} {number(total)}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, labels, buckets=request_buckets):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # The whole exposition, ready to send
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Re-sync the shows stored by API_Demo with TVMaze.
+
+TVMaze publishes when each show was last updated, so we only re-fetch the
+shows whose upstream timestamp is newer than the one stored with them, a
+batch at a time, and write each batch back in a single transaction. Run it
+once (e.g. from cron) or leave it running with --every:
+
+    python refresh.py --db storage.db --since day --every 3600
+
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import API_Demo as demo
+
+
+def refresh(cnx, client, since='day', batch_size=200, workers=8):
+    # Bring stale shows up to date; returns counts of what was done
+    updates = client.updates(since)
+    counts = {'checked': 0, 'stale': 0, 'updated': 0, 'missing': 0}
+
+    def fetch(id):
+        return id, client.show(id, cache=False)
+
+    # Walk the stored shows in id order, a batch at a time
+    last = -1
+    while True:
+        rows = cnx.execute(f'SELECT "tvmaze-id", "tvmaze-updated" FROM {demo.table_name} '
+                           f'WHERE "tvmaze-id" > ? ORDER BY "tvmaze-id" LIMIT ?', (last, batch_size)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        counts['checked'] += len(rows)
+
+        stale = [id for id, stored in rows if id in updates and (stored is None or updates[id] > stored)]
+        counts['stale'] += len(stale)
+        if not stale:
+            continue
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            fetched = list(pool.map(fetch, stale))
+
+        changed = []
+        added = demo.now()
+        for id, show in fetched:
+            # Gone from TVMaze; keep our copy rather than lose it
+            if show is None:
+                counts['missing'] += 1
+                continue
+            values, genres = demo.show_values(show)
+            values['last-update'] = added
+            changed.append((values, genres))
+
+        # Shows deleted while they were being fetched are left deleted
+        with cnx:
+            cnx.execute('BEGIN IMMEDIATE')
+            counts['updated'] += len(demo.update_shows(cnx, changed))
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-sync stored TV shows with TVMaze')
+    parser.add_argument('--db', default=demo.db_config['database'], help='SQLite database file')
+    parser.add_argument('--url', default=demo.tvmaze_config['url'], help='TVMaze API URL')
+    parser.add_argument('--since', default='day', choices=['day','week','month','all'],
+                        help='Only consider shows updated on TVMaze within this period')
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=demo.tvmaze_config['workers'],
+                        help='Concurrent requests to TVMaze')
+    parser.add_argument('--every', type=int, default=None,
+                        help='Keep running, refreshing every this many seconds')
+    args = parser.parse_args()
+
+    demo.db_config['database'] = args.db
+    demo.tvmaze_config['url'] = args.url
+
+    cnx = demo.get_db()
+    demo.init_db(cnx)
+
+    while True:
+        started = time.time()
+        try:
+            counts = refresh(cnx, demo.get_upstream(),
+                                     since=None if args.since == 'all' else args.since,
+                                     batch_size=args.batch_size,
+                                     workers=args.workers)
+            print(f'{demo.now()} checked {counts["checked"]}, stale {counts["stale"]}, '
+                  f'updated {counts["updated"]}, missing upstream {counts["missing"]} '
+                  f'in {time.time() - started:.1f}s')
+        except demo.tvmaze.TVMazeError as err:
+            print(f'{demo.now()} refresh failed: {err}')
+
+        if args.every is None:
+            break
+        time.sleep(max(0, args.every - (time.time() - started)))
+
+    demo.close_db()
+
+
+if __name__ == '__main__':
+    main()
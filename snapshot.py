@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory columnar copy of the shows table, for the statistics endpoint's
+group-bys (counts, shares and means by language, network, genre, runtime
+and so on) without scanning SQLite on every request.
+
+Text columns are dictionary encoded (an int32 code per show into a list of
+distinct values), numbers are float32 with NaN for missing, and genres are a
+matrix of codes, one row per show. Group-bys are then np.bincount over the
+codes. Shows are found by id through a sorted index of the id column rather
+than a dict, and removed shows are only marked dead until enough of them
+pile up.
+
+The snapshot records the data version it's up to date with; sync() reloads
+just the shows listed in Show_Changes since then, so writes made by any
+process (or any other program) are picked up incrementally.
+
+"""
+
+import numpy as np
+
+
+# Snapshot dimension: the TV_Shows column it's read from
+categories = {'language': 'language',
+              'status': 'status',
+              'type': 'type',
+              'network': 'network-name',
+              'country': 'network-country'}
+numbers = {'runtime': 'runtime',
+           'rating': 'rating-average',
+           'weight': 'weight',
+           'premiered': 'premiered'}    # stored as the year
+
+# Default bin widths when grouping by a number, and the most bins a width
+# can make (each one is a key in the response)
+widths = {'runtime': 15, 'rating': 1, 'weight': 10, 'premiered': 10}
+max_bins = 1000
+
+dimensions = list(categories) + ['genres'] + list(numbers)
+metrics = ['count', 'share'] + [f'mean-{name}' for name in ['runtime', 'rating', 'weight']]
+
+
+class TooManyGroups(Exception):
+    # Raised by group() when a width would make more than max_bins groups
+    pass
+
+
+def number(value):
+    # A number column's value as stored in the snapshot: NaN for NULL, and
+    # for anything that isn't a number (SQLite will keep text in a typed
+    # column if it doesn't look like one)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return np.nan
+
+
+class Dictionary:
+    # The distinct values of a column, each with its code
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class Snapshot:
+    def __init__(self, table_name='TV_Shows'):
+        self.table_name = table_name
+        self.version = None
+
+        self.size = 0
+        self.ids = np.zeros(0, dtype=np.int64)     # -1 once removed
+        self._order = None                          # argsort of ids, when known
+        self.alive = np.zeros(0, dtype=bool)
+        self.codes = {name: np.zeros(0, dtype=np.int32) for name in categories}
+        self.dictionaries = {name: Dictionary() for name in list(categories) + ['genres']}
+        self.numbers = {name: np.zeros(0, dtype=np.float32) for name in numbers}
+        self.genres = np.zeros((0, 4), dtype=np.int32)
+
+    def columns(self):
+        cols = ['"tvmaze-id"'] + [f'"{col}"' for col in list(categories.values()) + list(numbers.values())]
+        return ', '.join(cols)
+
+    def load(self, cnx, batch_size=10000):
+        # Read every show
+        self.version = cnx.execute('SELECT version FROM Show_Version').fetchone()[0]
+        cur = cnx.execute(f'SELECT {self.columns()} FROM {self.table_name} ORDER BY "tvmaze-id"')
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            self.upsert(rows, {}, new=True)
+
+        # Genres go in separately, as there's one row per genre
+        cur = cnx.execute('SELECT show_id, genre FROM Show_Genres ORDER BY show_id, position')
+        genres = {}
+        for show_id, genre in cur:
+            genres.setdefault(show_id, []).append(genre)
+        self.set_genres(genres)
+        return self
+
+    def sync(self, cnx):
+        # Catch up with changes made since the snapshot was last up to date.
+        # Changes are logged against the version current when they're made,
+        # which may be just before the bump for them, so look from our own
+        # version on (reloading a show twice does no harm).
+        version = cnx.execute('SELECT version FROM Show_Version').fetchone()[0]
+        if version == self.version:
+            return 0
+
+        changed = [row[0] for row in cnx.execute('SELECT show_id FROM Show_Changes WHERE version >= ?',
+                                                 (self.version,))]
+        for start in range(0, len(changed), 500):
+            chunk = changed[start:start + 500]
+            marks = ', '.join('?' for _ in chunk)
+            rows = cnx.execute(f'SELECT {self.columns()} FROM {self.table_name} '
+                               f'WHERE "tvmaze-id" IN ({marks})', chunk).fetchall()
+            genres = {id: [] for id in chunk}
+            for show_id, genre in cnx.execute(f'SELECT show_id, genre FROM Show_Genres '
+                                              f'WHERE show_id IN ({marks}) ORDER BY show_id, position', chunk):
+                genres[show_id].append(genre)
+
+            found = set(row[0] for row in rows)
+            self.remove([id for id in chunk if id not in found])
+            self.upsert(rows, {id: genres[id] for id in found})
+
+        self.version = version
+        return len(changed)
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+
+        def grown(array, fill):
+            out = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            out[:len(array)] = array
+            return out
+
+        self.ids = grown(self.ids, 0)
+        self.alive = grown(self.alive, False)
+        self.codes = {name: grown(array, -1) for name, array in self.codes.items()}
+        self.numbers = {name: grown(array, np.nan) for name, array in self.numbers.items()}
+        self.genres = grown(self.genres, -1)
+
+    def find(self, ids):
+        # Rows of the given show ids, -1 for any not in the snapshot
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.size == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        if self._order is None:
+            self._order = np.argsort(self.ids[:self.size], kind='stable')
+        ordered = self.ids[:self.size][self._order]
+        i = np.minimum(np.searchsorted(ordered, ids), self.size - 1)
+        return np.where(ordered[i] == ids, self._order[i], -1)
+
+    def upsert(self, rows, genres, new=False):
+        # Add or overwrite shows, given as rows of columns() and {id: genres};
+        # with new, the shows are known not to be in the snapshot yet
+        if not rows:
+            return self.set_genres(genres)
+
+        pos = np.full(len(rows), -1, dtype=np.int64) if new else self.find([row[0] for row in rows])
+        added = pos < 0
+        count = int(np.count_nonzero(added))
+        if count:
+            self._grow(self.size + count)
+            pos[added] = np.arange(self.size, self.size + count)
+            self.size += count
+            self._order = None
+
+        self.ids[pos] = [row[0] for row in rows]
+        self.alive[pos] = True
+
+        for i, name in enumerate(categories):
+            encode = self.dictionaries[name].encode
+            self.codes[name][pos] = [encode(row[1 + i]) for row in rows]
+        for i, name in enumerate(numbers):
+            values = [row[1 + len(categories) + i] for row in rows]
+            if name == 'premiered':
+                values = [int(value[:4]) if value and value[:4].isdigit() else None for value in values]
+            self.numbers[name][pos] = [number(value) for value in values]
+
+        self.set_genres(genres)
+
+    def set_genres(self, genres):
+        # Replace the genres of shows already in the snapshot
+        if not genres:
+            return
+        widest = max(len(names) for names in genres.values())
+        if widest > self.genres.shape[1]:
+            wider = np.full((len(self.genres), widest), -1, dtype=np.int32)
+            wider[:, :self.genres.shape[1]] = self.genres
+            self.genres = wider
+
+        encode = self.dictionaries['genres'].encode
+        for pos, names in zip(self.find(list(genres)), genres.values()):
+            if pos < 0:
+                continue
+            self.genres[pos] = -1
+            self.genres[pos, :len(names)] = [encode(name) for name in names]
+
+    def remove(self, ids):
+        pos = self.find(ids)
+        pos = pos[pos >= 0]
+        if len(pos) == 0:
+            return
+        self.alive[pos] = False
+        self.ids[pos] = -1
+        self._order = None
+
+        # Squeeze out removed shows once they're half of the rows
+        if np.count_nonzero(self.alive[:self.size]) * 2 < self.size:
+            keep = np.nonzero(self.alive[:self.size])[0]
+            self.ids = self.ids[keep]
+            self.alive = self.alive[keep]
+            self.codes = {name: array[keep] for name, array in self.codes.items()}
+            self.numbers = {name: array[keep] for name, array in self.numbers.items()}
+            self.genres = self.genres[keep]
+            self.size = len(keep)
+
+    def nbytes(self):
+        # Memory held by the arrays (not counting the dictionaries)
+        arrays = [self.ids, self.alive, self.genres] + list(self.codes.values()) + list(self.numbers.values())
+        return sum(array.nbytes for array in arrays)
+
+    def group(self, by, metric='count', width=None):
+        # Group the shows by a dimension and work out a metric for each group,
+        # returning ({group: value}, shows counted, shows with no value for by).
+        # Raises TooManyGroups if a width would make more than max_bins groups.
+        alive = self.alive[:self.size]
+        total = int(np.count_nonzero(alive))
+
+        if by in categories:
+            codes = self.codes[by][:self.size]
+            mask = alive & (codes >= 0)
+            rows = np.nonzero(mask)[0]
+            keys = codes[rows]
+            labels = self.dictionaries[by].values
+            shows = len(rows)
+        elif by == 'genres':
+            matrix = self.genres[:self.size]
+            mask = (matrix >= 0) & alive[:, None]
+            rows = np.nonzero(mask)[0]
+            keys = matrix[mask]
+            labels = self.dictionaries['genres'].values
+            shows = int(np.count_nonzero(mask.any(axis=1)))
+        else:
+            # Numbers are grouped into bins 'width' wide, labelled by their
+            # lower bound
+            width = width or widths[by]
+            column = self.numbers[by][:self.size]
+            rows = np.nonzero(alive & ~np.isnan(column))[0]
+            bins = np.floor(column[rows].astype(np.float64) / width)
+            if len(bins) and not (np.isfinite(bins).all() and bins.max() - bins.min() < max_bins):
+                raise TooManyGroups(f'grouping {by} {width:g} wide would make more than {max_bins} groups')
+            low = int(bins.min()) if len(bins) else 0
+            keys = (bins - low).astype(np.int64)
+            labels = [f'{(low + i) * width:g}' for i in range(int(keys.max()) + 1 if len(keys) else 0)]
+            shows = len(rows)
+
+        counts = np.bincount(keys, minlength=len(labels))
+
+        if metric == 'count':
+            values = counts.tolist()
+        elif metric == 'share':
+            values = np.round(counts * 100 / max(shows, 1), 2).tolist()
+        else:
+            # Means skip shows without the number
+            column = self.numbers[metric[len('mean-'):]][rows]
+            known = ~np.isnan(column)
+            sums = np.bincount(keys[known], weights=column[known], minlength=len(labels))
+            known = np.bincount(keys[known], minlength=len(labels))
+            values = [None if n == 0 else round(float(s / n), 2) for s, n in zip(sums, known)]
+
+        groups = {str(label): value for label, value, count in zip(labels, values, counts) if count > 0}
+        if by in categories or by == 'genres':
+            groups = dict(sorted(groups.items()))
+        return groups, shows, total - shows
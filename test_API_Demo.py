@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the parts of API_Demo that are easiest to get subtly wrong: keyset
+pagination over sort keys with NULLs in them, migrating databases made by
+the original pandas version of the app, and writes that carry values of the
+wrong type or race with a delete.
+
+    python -m pytest -q
+
+"""
+
+import json
+import random
+import sqlite3
+import functools
+from urllib.parse import urlsplit, urlencode
+
+import pytest
+
+import API_Demo as demo
+import refresh
+import tvmaze
+
+
+def make_app(database):
+    app = demo.create_app({'DATABASE': str(database)})
+    app.testing = True
+    return app
+
+
+# Keyset pagination
+
+@pytest.fixture(scope='module')
+def shows(tmp_path_factory):
+    # Shows with lots of NULLs and ties in every sortable field, under ids
+    # that aren't contiguous
+    rng = random.Random(0)
+    out = []
+    for id in rng.sample(range(1, 1000), 57):
+        out.append({'id': id,
+                    'name': rng.choice(['Alpha', 'Beta', 'Gamma']),
+                    'runtime': rng.choice([None, None, 30, 60]),
+                    'premiered': rng.choice([None, '1999-05-01', '2010-09-12']),
+                    'rating': {'average': rng.choice([None, None, 6.5, 8.0])},
+                    'genres': []})
+
+    database = tmp_path_factory.mktemp('keyset') / 'storage.db'
+    cnx = demo.connect(str(database))
+    demo.init_db(cnx)
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in out])
+    cnx.close()
+    return database, out
+
+
+def reference(shows, order_by):
+    # Ids in the order SQLite should give them: NULLs sort first ascending
+    # and last descending, and ties go by id, in the direction of the last key
+    fields = {'id': lambda show: show['id'],
+              'name': lambda show: show['name'],
+              'runtime': lambda show: show['runtime'],
+              'premiered': lambda show: show['premiered'],
+              'rating-average': lambda show: show['rating']['average']}
+    keys = [(fields[name[1:]], name[0] == '+') for name in order_by.split(',')]
+    if 'id' not in [name[1:] for name in order_by.split(',')]:
+        keys.append((fields['id'], keys[-1][1]))
+
+    def compare(a, b):
+        for field, asc in keys:
+            x, y = (field(a) is not None, field(a)), (field(b) is not None, field(b))
+            if x != y:
+                return (-1 if x < y else 1) * (1 if asc else -1)
+        return 0
+
+    return [show['id'] for show in sorted(shows, key=functools.cmp_to_key(compare))]
+
+
+def follow(client, url):
+    # GET a link from a response (they're absolute), returning the page
+    parts = urlsplit(url)
+    resp = client.get(f'{parts.path}?{parts.query}'.replace(' ', '+'))
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    return resp.get_json()
+
+
+@pytest.mark.parametrize('order_by', ['+id', '-id', '+runtime', '-runtime', '+rating-average',
+                                      '-rating-average', '+name', '-premiered,+runtime',
+                                      '+runtime,-rating-average', '-name,+premiered,-runtime'])
+def test_cursor_round_trip(shows, order_by):
+    database, data = shows
+    client = make_app(database).test_client()
+    expected = reference(data, order_by)
+
+    # Forwards from the start, following next links
+    pages = [follow(client, f'/tv-shows?order_by={order_by}&page_size=7&filter=id&cursor=')]
+    while 'next' in pages[-1]['_links']:
+        pages.append(follow(client, pages[-1]['_links']['next']['href']))
+    forwards = [[show['id'] for show in page['tv-shows']] for page in pages]
+    assert [id for page in forwards for id in page] == expected
+
+    # Then back again from the last page, following previous links, which
+    # should give the same pages in reverse
+    backwards = [forwards[-1]]
+    page = pages[-1]
+    while 'previous' in page['_links']:
+        page = follow(client, page['_links']['previous']['href'])
+        backwards.insert(0, [show['id'] for show in page['tv-shows']])
+    assert backwards == forwards
+
+
+# Migrating old databases
+
+def baseline_db(database, shows):
+    # A storage.db as the first version of the app made it: pandas created
+    # the table from an empty DataFrame, so every column is TEXT, there's an
+    # 'index' column and no key, and nested fields were stored as JSON
+    cnx = sqlite3.connect(str(database))
+    cnx.execute('CREATE TABLE "TV_Shows" ("index" INTEGER, "tvmaze-id" TEXT, "name" TEXT, "type" TEXT, '
+                '"language" TEXT, "genres" TEXT, "status" TEXT, "runtime" TEXT, "premiered" TEXT, '
+                '"officialSite" TEXT, "schedule" TEXT, "rating" TEXT, "weight" TEXT, "network" TEXT, '
+                '"summary" TEXT, "last-update" TEXT)')
+    cnx.execute('CREATE INDEX "ix_TV_Shows_index" ON "TV_Shows" ("index")')
+    for show in shows:
+        cnx.execute('INSERT INTO TV_Shows ("tvmaze-id", name, type, language, genres, status, runtime, premiered, '
+                    '"officialSite", schedule, rating, weight, network, summary, "last-update") '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (show['id'], show['name'], show['type'], show['language'], json.dumps(show['genres']),
+                     show['status'], show['runtime'], show['premiered'], show['officialSite'],
+                     json.dumps(show['schedule']), json.dumps(show['rating']), show['weight'],
+                     json.dumps(show['network']), show['summary'], '2021-03-21 20:58:06'))
+    cnx.commit()
+    cnx.close()
+
+
+old_shows = [{'id': 139, 'name': 'Girls', 'type': 'Scripted', 'language': 'English',
+              'genres': ['Drama', 'Romance'], 'status': 'Ended', 'runtime': 30, 'premiered': '2012-04-15',
+              'officialSite': 'http://www.hbo.com/girls', 'schedule': {'time': '22:00', 'days': ['Sunday']},
+              'rating': {'average': 6.7}, 'weight': 97,
+              'network': {'id': 8, 'name': 'HBO',
+                          'country': {'name': 'United States', 'code': 'US', 'timezone': 'America/New_York'}},
+              'summary': '<p>This Emmy winning series is a comic look at the assorted humiliations.</p>'},
+             {'id': 1505, 'name': 'Scrubs', 'type': 'Scripted', 'language': 'English',
+              'genres': ['Comedy', 'Medical'], 'status': 'Ended', 'runtime': 120, 'premiered': '2001-10-02',
+              'officialSite': None, 'schedule': {'time': '', 'days': []},
+              'rating': {'average': None}, 'weight': 89, 'network': None,
+              'summary': '<p><b>Scrubs</b> follows the lives of hospital staff.</p>'},
+             {'id': 7, 'name': 'Tokyo Nights', 'type': 'Reality', 'language': 'Japanese',
+              'genres': [], 'status': 'Running', 'runtime': None, 'premiered': None,
+              'officialSite': None, 'schedule': {'time': '21:00', 'days': ['Monday', 'Friday']},
+              'rating': {'average': 8.1}, 'weight': 5,
+              'network': {'id': 12, 'name': 'NHK', 'country': None},
+              'summary': None}]
+
+
+def test_migrate_baseline_db(tmp_path):
+    database = tmp_path / 'storage.db'
+    baseline_db(database, old_shows)
+    client = make_app(database).test_client()
+
+    cnx = sqlite3.connect(str(database))
+    assert cnx.execute('PRAGMA user_version').fetchone()[0] == demo.schema_version
+    columns = {row[1]: (row[2], row[5]) for row in cnx.execute('PRAGMA table_info(TV_Shows)')}
+    assert columns['tvmaze-id'] == ('INTEGER', 1)
+    assert 'index' not in columns and 'genres' not in columns
+    cnx.close()
+
+    # Every show comes back in the shape it went in
+    for show in old_shows:
+        got = client.get(f'/tv-shows/{show["id"]}').get_json()
+        for field in ['name', 'type', 'language', 'genres', 'status', 'runtime', 'premiered', 'officialSite',
+                      'schedule', 'rating', 'weight', 'network', 'summary']:
+            assert got[field] == show[field], field
+
+    # Runtimes were TEXT, so they only sort as numbers once converted
+    page = client.get('/tv-shows?order_by=-runtime&filter=id,runtime').get_json()
+    assert [show['id'] for show in page['tv-shows']] == [1505, 139, 7]
+
+    # The derived tables were built from the migrated rows
+    stats = client.get('/tv-shows/statistics?by=language').get_json()
+    assert stats['total'] == 3
+    assert stats['values'] == {'English': 66.7, 'Japanese': 33.3}
+    found = client.get('/tv-shows/search?q=hospital').get_json()
+    assert [show['id'] for show in found['tv-shows']] == [1505]
+
+
+def test_failed_migration_leaves_db_as_it_was(tmp_path, monkeypatch):
+    # The migration is one transaction: if it fails at the last step, the
+    # DB is still the old one, and migrating it again works
+    database = tmp_path / 'storage.db'
+    baseline_db(database, old_shows)
+
+    def fail(cnx):
+        raise RuntimeError('interrupted')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(demo, 'rebuild_search', fail)
+        with pytest.raises(RuntimeError):
+            make_app(database)
+
+    cnx = sqlite3.connect(str(database))
+    assert cnx.execute('PRAGMA user_version').fetchone()[0] == 0
+    assert 'index' in [row[1] for row in cnx.execute('PRAGMA table_info(TV_Shows)')]
+    cnx.close()
+
+    client = make_app(database).test_client()
+    assert client.get('/tv-shows/139').get_json()['name'] == 'Girls'
+
+
+# Apps made by create_app
+
+def test_apps_keep_their_own_settings(tmp_path):
+    # Making a second app (with its own DB) doesn't move the first one, and
+    # cached pages aren't shared between them
+    first = make_app(tmp_path / 'first.db')
+    cnx = demo.connect(str(tmp_path / 'first.db'))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values({'id': 1, 'name': 'First'})])
+    cnx.close()
+    assert first.test_client().get('/tv-shows').get_json()['tv-shows'] == [{'id': 1, 'name': 'First'}]
+
+    second = make_app(tmp_path / 'second.db')
+    assert second.test_client().get('/tv-shows').get_json()['tv-shows'] == []
+    assert first.test_client().get('/tv-shows').get_json()['tv-shows'] == [{'id': 1, 'name': 'First'}]
+    assert demo.db_config['database'] == 'storage.db'
+
+
+# Grouped statistics
+
+def test_text_in_a_number_column_is_left_out_of_groups(tmp_path):
+    # A number column holding text (which SQLite keeps as it is, and PATCH
+    # used to let through) counts as missing, rather than breaking the
+    # snapshot for every later request
+    database = tmp_path / 'storage.db'
+    client = make_app(database).test_client()
+    cnx = demo.connect(str(database))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in old_shows])
+    cnx.close()
+
+    url = '/tv-shows/statistics?by=weight&metric=count'
+    assert client.get(url).get_json()['values'] == {'0': 1, '80': 1, '90': 1}
+
+    cnx = sqlite3.connect(str(database))
+    with cnx:
+        cnx.execute('UPDATE TV_Shows SET weight = ? WHERE "tvmaze-id" = ?', ('heavy', 139))
+    cnx.close()
+    got = client.get(url).get_json()
+    assert got['values'] == {'0': 1, '80': 1}
+    assert got['missing'] == 1
+    got = client.get('/tv-shows/statistics?by=language&metric=mean-weight').get_json()
+    assert got['values'] == {'English': 89.0, 'Japanese': 5.0}
+
+
+def test_charts_are_drawn_outside_the_cache_lock(tmp_path, monkeypatch):
+    # Other charts' cache hits shouldn't wait on a render
+    database = tmp_path / 'storage.db'
+    client = make_app(database).test_client()
+    cnx = demo.connect(str(database))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in old_shows])
+    cnx.close()
+
+    drawn = []
+
+    def render(by, counts, values):
+        drawn.append(demo.chart_lock.locked())
+        return f'{by} {sorted(values.items())}'.encode()
+
+    monkeypatch.setattr(demo, 'render_chart', render)
+    first = client.get('/tv-shows/statistics?by=language&format=image').get_data()
+    assert client.get('/tv-shows/statistics?by=language&format=image').get_data() == first
+    assert drawn == [False]
+    assert first.startswith(b'language')
+
+
+# Updating shows
+
+@pytest.mark.parametrize('fields', [{'name': ['x']}, {'name': {'a': 1}}, {'type': 1}, {'language': True},
+                                    {'status': []}, {'premiered': 20150101}, {'officialSite': {}},
+                                    {'runtime': 'abc'}, {'runtime': 30.5}, {'weight': 'heavy'},
+                                    {'weight': True}, {'network': {'name': ['HBO']}},
+                                    {'network': {'country': {'name': 1}}}])
+def test_patch_checks_value_types(tmp_path, fields):
+    database = tmp_path / 'storage.db'
+    client = make_app(database).test_client()
+    cnx = demo.connect(str(database))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in old_shows])
+    cnx.close()
+
+    resp = client.patch('/tv-shows/139', json=fields)
+    assert resp.status_code == 404, resp.get_data(as_text=True)
+    assert client.get('/tv-shows/139').get_json()['name'] == 'Girls'
+
+    # In a batch, only that item is rejected
+    resp = client.patch('/tv-shows', json=[{'id': 139, 'fields': fields}, {'id': 1505, 'fields': {'name': 'ok'}}])
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    results = resp.get_json()['results']
+    assert [result['status'] for result in results] == ['invalid', 'updated']
+    assert client.get('/tv-shows/1505').get_json()['name'] == 'ok'
+
+
+def test_patch_takes_null_and_right_types(tmp_path):
+    database = tmp_path / 'storage.db'
+    client = make_app(database).test_client()
+    cnx = demo.connect(str(database))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in old_shows])
+    cnx.close()
+
+    fields = {'name': 'Boys', 'officialSite': None, 'runtime': 45, 'weight': None,
+              'network': {'id': 9, 'name': 'HBO', 'country': {'name': 'United States', 'code': 'US'}}}
+    assert client.patch('/tv-shows/139', json=fields).status_code == 200
+    got = client.get('/tv-shows/139').get_json()
+    assert (got['name'], got['officialSite'], got['runtime'], got['weight']) == ('Boys', None, 45, None)
+
+
+# Refreshing from TVMaze
+
+def test_refresh_skips_shows_deleted_while_fetching(tmp_path):
+    # A show deleted between being picked as stale and the write stays
+    # deleted, without leaving its genres or their counts behind
+    database = tmp_path / 'storage.db'
+    cnx = demo.connect(str(database))
+    demo.init_db(cnx)
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in old_shows])
+
+    class Upstream:
+        def updates(self, since):
+            return {show['id']: 100 for show in old_shows}
+
+        def show(self, id, cache=True):
+            if id == 139:
+                other = demo.connect(str(database))
+                with other:
+                    other.execute('DELETE FROM TV_Shows WHERE "tvmaze-id" = 139')
+                other.close()
+            return dict(next(show for show in old_shows if show['id'] == id), genres=['Comedy'], updated=100)
+
+    counts = refresh.refresh(cnx, Upstream(), workers=1)
+    assert counts['stale'] == 3 and counts['updated'] == 2
+    assert cnx.execute('SELECT COUNT(*) FROM Show_Genres WHERE show_id = 139').fetchone()[0] == 0
+    genre_stats = cnx.execute('SELECT * FROM Genre_Stats ORDER BY 1, 2').fetchall()
+    with cnx:
+        demo.rebuild_stats(cnx)
+    assert cnx.execute('SELECT * FROM Genre_Stats ORDER BY 1, 2').fetchall() == genre_stats
+
+    # And it can be imported again
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(old_shows[0])])
+    cnx.close()
+
+
+# Filtering
+
+@pytest.mark.parametrize('date', ['2012-04-15', '20120415', '2012-W15-7'])
+def test_premiered_dates_in_any_iso_form(tmp_path, date):
+    database = tmp_path / 'storage.db'
+    client = make_app(database).test_client()
+    cnx = demo.connect(str(database))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in old_shows])
+    cnx.close()
+
+    got = client.get(f'/tv-shows?premiered_from={date}&filter=id').get_json()
+    assert [show['id'] for show in got['tv-shows']] == [139]
+    got = client.get(f'/tv-shows?premiered_to={date}&filter=id').get_json()
+    assert [show['id'] for show in got['tv-shows']] == [139, 1505]
+
+
+# Importing from TVMaze
+
+def test_bulk_import_gives_a_result_for_every_name(tmp_path):
+    # Searches are served from recorded responses; Nope isn't recorded, so
+    # TVMaze doesn't know it
+    fixtures = tmp_path / 'fixtures'
+    fixtures.mkdir()
+    backend = tvmaze.FixtureBackend(str(fixtures))
+    for show in old_shows[:2]:
+        with open(backend.filename('/search/shows', urlencode({'q': show['name']})), 'w') as f:
+            json.dump({'status': 200, 'body': [{'score': 1.0, 'show': show}]}, f)
+    app = demo.create_app({'DATABASE': str(tmp_path / 'storage.db'), 'TVMAZE_FIXTURES': str(fixtures)})
+    client = app.test_client()
+
+    resp = client.post('/tv-shows/import/bulk', json=['Girls', 'girls', 'Scrubs', 'Nope', 'GIRLS'])
+    assert resp.status_code == 201
+    results = resp.get_json()['results']
+    assert [(result['name'], result['status'], result.get('id')) for result in results] == \
+        [('Girls', 'created', 139), ('girls', 'duplicate', 139), ('Scrubs', 'created', 1505),
+         ('Nope', 'not-found', None), ('GIRLS', 'duplicate', 139)]
+    assert resp.get_json()['created'] == 2
+
+
+def test_export_reads_with_the_apps_db_settings(tmp_path, monkeypatch):
+    # The export body is streamed after the app context has gone, so the
+    # connection it opens must still get this app's settings
+    app = demo.create_app({'DATABASE': str(tmp_path / 'storage.db'), 'TVMAZE_WORKERS': 2})
+    settings = app.extensions['api_demo']
+    assert settings['tvmaze']['workers'] == 2 and demo.tvmaze_config['workers'] == 8
+    settings['db']['timeout'] = 1.5
+
+    opened = []
+    connect = demo.connect
+
+    def spy(database=None, config=None):
+        cnx = connect(database, config)
+        opened.append(cnx.execute('PRAGMA busy_timeout').fetchone()[0])
+        return cnx
+
+    monkeypatch.setattr(demo, 'connect', spy)
+    resp = app.test_client().get('/tv-shows/export')
+    assert resp.status_code == 200 and resp.get_data() == b''
+    assert opened[-1] == 1500
+
+
+
+# Searching
+
+def test_search_links_keep_the_query(tmp_path):
+    database = tmp_path / 'storage.db'
+    client = make_app(database).test_client()
+    shows = [{'id': id, 'name': f'Tom & Jerry {id}', 'summary': '<p>Cat chases mouse.</p>'} for id in range(1, 6)]
+    cnx = demo.connect(str(database))
+    with cnx:
+        demo.insert_shows(cnx, [demo.show_values(show) for show in shows])
+    cnx.close()
+
+    page = client.get('/tv-shows/search', query_string={'q': 'tom & jerry', 'page_size': 2}).get_json()
+    ids = [show['id'] for show in page['tv-shows']]
+    while 'next' in page['_links']:
+        page = follow(client, page['_links']['next']['href'])
+        assert page['q'] == 'tom & jerry'
+        ids += [show['id'] for show in page['tv-shows']]
+    assert sorted(ids) == [1, 2, 3, 4, 5]
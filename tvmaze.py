@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Client for the TVMaze API, used by API_Demo to import and refresh shows.
+
+Requests go through a backend: HTTPBackend talks to the real API over
+keep-alive connections, and FixtureBackend serves responses recorded on disk
+(optionally recording any it doesn't have yet) for offline tests and
+benchmarks. The Client on top retries with backoff, waits out rate limits and
+keeps an LRU cache of responses with a time to live.
+
+"""
+
+import json
+import time
+import threading
+import http.client
+import urllib.parse
+from collections import OrderedDict
+import os
+
+
+class TVMazeError(Exception):
+    # Raised when TVMaze can't give us an answer (after retrying)
+    pass
+
+
+class HTTPBackend:
+    def __init__(self, url, timeout=10):
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+
+        # One connection per thread, kept open between requests
+        self._local = threading.local()
+
+    def _connection(self):
+        cnx = getattr(self._local, 'cnx', None)
+        if cnx is None:
+            kind = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            cnx = kind(self.host, timeout=self.timeout)
+            self._local.cnx = cnx
+        return cnx
+
+    def close(self):
+        cnx = getattr(self._local, 'cnx', None)
+        if cnx is not None:
+            cnx.close()
+            self._local.cnx = None
+
+    def get(self, path, query):
+        # Returns (status, headers, body). A kept-alive connection may have
+        # been closed by the server since we last used it, so try once more
+        # on a fresh connection before giving up.
+        target = f'{self.prefix}{path}?{query}' if query else f'{self.prefix}{path}'
+        for attempt in range(2):
+            cnx = self._connection()
+            try:
+                cnx.request('GET', target, headers={'Accept': 'application/json'})
+                resp = cnx.getresponse()
+                return resp.status, dict(resp.getheaders()), resp.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt == 1:
+                    raise
+            except OSError:
+                self.close()
+                raise
+
+
+class FixtureBackend:
+    def __init__(self, directory, record=None):
+        # Responses live in 'directory', one file per path and query. With
+        # 'record' (another backend), anything missing is fetched from it
+        # and saved for next time; otherwise it's a 404.
+        self.directory = directory
+        self.record = record
+
+    def filename(self, path, query):
+        return os.path.join(self.directory, urllib.parse.quote(f'{path}?{query}', safe='') + '.json')
+
+    def get(self, path, query):
+        filename = self.filename(path, query)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                saved = json.load(f)
+            return saved['status'], {}, json.dumps(saved['body']).encode()
+
+        if self.record is None:
+            return 404, {}, b'null'
+
+        status, headers, body = self.record.get(path, query)
+        if status == 200 or status == 404:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(filename, 'w') as f:
+                json.dump({'status': status, 'body': json.loads(body or b'null')}, f, indent=1)
+        return status, headers, body
+
+    def close(self):
+        if self.record is not None:
+            self.record.close()
+
+
+class Client:
+    def __init__(self, backend, retries=3, backoff=0.5, cache_size=1024, cache_ttl=3600):
+        self.backend = backend
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_json(self, path, params=None, cache=True):
+        # Decoded JSON for a path, or None if TVMaze says it doesn't exist
+        query = urllib.parse.urlencode(sorted((params or {}).items()))
+        key = (path, query)
+
+        if cache:
+            with self._lock:
+                hit = self._cache.get(key)
+                if hit is not None and hit[0] > time.monotonic():
+                    self._cache.move_to_end(key)
+                    return hit[1]
+
+        value = self._fetch(path, query)
+
+        if cache and self.cache_size > 0:
+            with self._lock:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, value)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return value
+
+    def _fetch(self, path, query):
+        # Retry connection problems, server errors, rate limiting and bodies
+        # that aren't JSON (e.g. a maintenance page sent with a 200) with an
+        # exponential backoff; on a 429, wait as long as TVMaze asks us to.
+        # Whatever goes wrong, callers only ever see a TVMazeError.
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(error[1] if error[1] is not None else self.backoff * (2 ** (attempt - 1)))
+
+            try:
+                status, headers, body = self.backend.get(path, query)
+            except (OSError, http.client.HTTPException) as err:
+                error = (f'Could not reach TVMaze: {err}', None)
+                continue
+
+            if status == 200:
+                try:
+                    return json.loads(body)
+                except ValueError:
+                    error = (f'TVMaze returned a response that isn\'t JSON for {path}', None)
+                    continue
+            if status == 404:
+                return None
+            if status == 429 or status >= 500:
+                retry_after = headers.get('Retry-After')
+                error = (f'TVMaze returned {status} for {path}',
+                         float(retry_after) if retry_after and retry_after.isdigit() else None)
+                continue
+            raise TVMazeError(f'TVMaze returned {status} for {path}')
+
+        raise TVMazeError(error[0])
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        self.backend.close()
+
+    def search_shows(self, name):
+        # Every search result for a name, each a dict with 'score' and 'show'
+        return self.get_json('/search/shows', {'q': name}) or []
+
+    def show(self, id, cache=True):
+        # A single show by its id, or None if it no longer exists
+        return self.get_json(f'/shows/{id}', cache=cache)
+
+    def updates(self, since=None):
+        # When each show was last updated on TVMaze, as {id: timestamp}, for
+        # every show or just those updated in the last 'day', 'week' or 'month'
+        params = {'since': since} if since else None
+        updated = self.get_json('/updates/shows', params, cache=False) or {}
+        return {int(id): timestamp for id, timestamp in updated.items()}